@@ -1,25 +1,67 @@
 """init
 
 Revision ID: 321b02daec61
-Revises: 794984518147
+Revises:
 Create Date: 2019-08-30 18:23:49.039836
 
 """
+from alembic import op
+import sqlalchemy as sa
+
 
 # revision identifiers, used by Alembic.
 revision = '321b02daec61'
-down_revision = '794984518147'
+down_revision = None
 branch_labels = None
 depends_on = None
 
 
 def upgrade():
-    # ### commands auto generated by Alembic - please adjust! ###
-    pass
-    # ### end Alembic commands ###
+    # Schema used to be created by models on import, so on old databases these tables exist already.
+    tables = sa.inspect(op.get_bind()).get_table_names()
+
+    if 'users' not in tables:
+        op.create_table(
+            'users',
+            sa.Column('user_id', sa.Integer(), primary_key=True),
+            sa.Column('chat_id', sa.Integer()),
+            sa.Column('first_name', sa.String(), nullable=False),
+            sa.Column('last_name', sa.String()),
+            sa.Column('username', sa.String()),
+            sa.Column('is_renter', sa.Boolean()),
+            sa.Column('is_muted', sa.Boolean()),
+        )
+    if 'rates' not in tables:
+        op.create_table(
+            'rates',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            *(sa.Column(column, sa.Float()) for column in ('water', 'gas', 'electricity_before_100',
+                                                           'electricity_after_100', 'garbage_removal', 'sdpt',
+                                                           'flat', 'flat_summer')),
+        )
+    if 'flat_payments' not in tables:
+        op.create_table(
+            'flat_payments',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('month_number', sa.Integer()),
+            sa.Column('year', sa.Integer()),
+            sa.Column('is_paid', sa.Boolean()),
+            sa.UniqueConstraint('year', 'month_number', name='_year_month_uc'),
+        )
+    if 'counters' not in tables:
+        op.create_table(
+            'counters',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('electricity', sa.Integer()),
+            sa.Column('gas', sa.Integer()),
+            sa.Column('water', sa.Integer()),
+            sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.user_id')),
+            sa.Column('gas_counter_photo_url', sa.String()),
+            sa.Column('created', sa.DateTime(timezone=True), server_default=sa.func.now()),
+            sa.Column('updated', sa.DateTime(timezone=True)),
+        )
 
 
 def downgrade():
-    # ### commands auto generated by Alembic - please adjust! ###
-    pass
-    # ### end Alembic commands ###
+    for table in ('counters', 'flat_payments', 'rates', 'users'):
+        op.drop_table(table)
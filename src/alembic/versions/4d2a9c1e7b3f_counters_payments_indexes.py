@@ -0,0 +1,40 @@
+"""counters and flat payments indexes
+
+Revision ID: 4d2a9c1e7b3f
+Revises: 321b02daec61
+Create Date: 2026-10-18 10:12:31.402117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4d2a9c1e7b3f'
+down_revision = '321b02daec61'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_counters_user_id_updated', 'counters', ['user_id', 'updated']),
+    ('ix_counters_user_id_created', 'counters', ['user_id', 'created']),
+    ('ix_flat_payments_is_paid_year_month', 'flat_payments', ['is_paid', 'year', 'month_number']),
+]
+
+
+def existing_indexes(table):
+    inspector = sa.inspect(op.get_bind())
+    return {index['name'] for index in inspector.get_indexes(table)}
+
+
+def upgrade():
+    # models.create_all may have created the indexes already on a fresh database.
+    for name, table, columns in INDEXES:
+        if name not in existing_indexes(table):
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, columns in INDEXES:
+        if name in existing_indexes(table):
+            op.drop_index(name, table_name=table)
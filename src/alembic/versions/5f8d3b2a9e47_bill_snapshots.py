@@ -0,0 +1,44 @@
+"""bill snapshots
+
+Revision ID: 5f8d3b2a9e47
+Revises: e3a94b7d15c8
+Create Date: 2026-10-18 14:21:37.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f8d3b2a9e47'
+down_revision = 'e3a94b7d15c8'
+branch_labels = None
+depends_on = None
+
+BILL_COLUMNS = ['flat_price', 'exchange_rate', 'flat', 'electricity', 'gas', 'water', 'sdpt', 'garbage_removal',
+                'heating', 'total']
+
+
+def upgrade():
+    # models.create_all may have created the table already.
+    inspector = sa.inspect(op.get_bind())
+    if 'bill_snapshots' not in inspector.get_table_names():
+        op.create_table(
+            'bill_snapshots',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('flat_id', sa.Integer(), sa.ForeignKey('flats.id'), nullable=False),
+            sa.Column('counters_id', sa.Integer(), sa.ForeignKey('counters.id')),
+            sa.Column('rates_version', sa.Integer()),
+            sa.Column('reason', sa.String()),
+            *(sa.Column(column, sa.Float()) for column in BILL_COLUMNS),
+            sa.Column('pending', sa.String()),
+            sa.Column('last_counters_created', sa.DateTime(timezone=True)),
+            sa.Column('created', sa.DateTime(timezone=True), server_default=sa.func.now()),
+        )
+    if 'ix_bill_snapshots_flat_id_id' not in {index['name'] for index in inspector.get_indexes('bill_snapshots')}:
+        op.create_index('ix_bill_snapshots_flat_id_id', 'bill_snapshots', ['flat_id', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_bill_snapshots_flat_id_id', table_name='bill_snapshots')
+    op.drop_table('bill_snapshots')
@@ -0,0 +1,31 @@
+"""rates version
+
+Revision ID: 8b5e0f3a6c21
+Revises: 4d2a9c1e7b3f
+Create Date: 2026-10-18 11:03:54.118820
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b5e0f3a6c21'
+down_revision = '4d2a9c1e7b3f'
+branch_labels = None
+depends_on = None
+
+
+def existing_columns(table):
+    inspector = sa.inspect(op.get_bind())
+    return {column['name'] for column in inspector.get_columns(table)}
+
+
+def upgrade():
+    if 'version' not in existing_columns('rates'):
+        op.add_column('rates', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    with op.batch_alter_table('rates') as batch_op:
+        batch_op.drop_column('version')
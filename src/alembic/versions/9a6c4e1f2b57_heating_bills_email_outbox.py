@@ -0,0 +1,59 @@
+"""heating bills and email outbox
+
+Revision ID: 9a6c4e1f2b57
+Revises: 5f8d3b2a9e47
+Create Date: 2026-10-18 15:02:44.610937
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a6c4e1f2b57'
+down_revision = '5f8d3b2a9e47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # These tables used to be created only by models.create_all on import, so they may exist already.
+    inspector = sa.inspect(op.get_bind())
+    tables = inspector.get_table_names()
+
+    if 'heating_bills' not in tables:
+        op.create_table(
+            'heating_bills',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('account', sa.String(), nullable=False),
+            sa.Column('year', sa.Integer(), nullable=False),
+            sa.Column('month_number', sa.Integer(), nullable=False),
+            sa.Column('sum_topay', sa.Float()),
+            sa.Column('created', sa.DateTime(timezone=True), server_default=sa.func.now()),
+            sa.UniqueConstraint('account', 'year', 'month_number', name='_account_year_month_uc'),
+        )
+
+    if 'email_outbox' not in tables:
+        op.create_table(
+            'email_outbox',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('subject', sa.String()),
+            sa.Column('body', sa.Text()),
+            sa.Column('template_id', sa.String()),
+            sa.Column('template_data', sa.Text()),
+            sa.Column('attachment_path', sa.String()),
+            sa.Column('status', sa.String(), nullable=False),
+            sa.Column('attempts', sa.Integer(), nullable=False),
+            sa.Column('last_error', sa.Text()),
+            sa.Column('next_attempt_at', sa.DateTime(), nullable=False),
+            sa.Column('created', sa.DateTime(timezone=True), server_default=sa.func.now()),
+            sa.Column('sent_at', sa.DateTime()),
+        )
+    if 'ix_email_outbox_status_next_attempt_at' not in {index['name'] for index in inspector.get_indexes('email_outbox')}:
+        op.create_index('ix_email_outbox_status_next_attempt_at', 'email_outbox', ['status', 'next_attempt_at'])
+
+
+def downgrade():
+    op.drop_index('ix_email_outbox_status_next_attempt_at', table_name='email_outbox')
+    op.drop_table('email_outbox')
+    op.drop_table('heating_bills')
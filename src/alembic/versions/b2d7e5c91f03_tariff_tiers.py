@@ -0,0 +1,53 @@
+"""tariff tiers
+
+Revision ID: b2d7e5c91f03
+Revises: 9a6c4e1f2b57
+Create Date: 2026-10-18 18:02:51.460913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2d7e5c91f03'
+down_revision = '9a6c4e1f2b57'
+branch_labels = None
+depends_on = None
+
+EPOCH = '1970-01-01'
+ELECTRICITY_FIRST_TIER = 100
+# utility, start, rates column
+RATES_TIERS = [('electricity', 0, 'electricity_before_100'),
+               ('electricity', ELECTRICITY_FIRST_TIER, 'electricity_after_100'),
+               ('gas', 0, 'gas'),
+               ('water', 0, 'water')]
+
+
+def upgrade():
+    # models.create_all may have created the table already.
+    inspector = sa.inspect(op.get_bind())
+    if 'tariff_tiers' not in inspector.get_table_names():
+        op.create_table(
+            'tariff_tiers',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('flat_id', sa.Integer(), sa.ForeignKey('flats.id'), nullable=False),
+            sa.Column('utility', sa.String(), nullable=False),
+            sa.Column('effective_from', sa.Date(), nullable=False),
+            sa.Column('start', sa.Float(), nullable=False),
+            sa.Column('price', sa.Float(), nullable=False),
+            sa.UniqueConstraint('flat_id', 'utility', 'effective_from', 'start', name='_tariff_tier_uc'),
+        )
+
+    # Current rates become the first version of every flat, in effect since ever.
+    for utility, start, column in RATES_TIERS:
+        op.execute(f"INSERT INTO tariff_tiers (flat_id, utility, effective_from, start, price) "
+                   f"SELECT flat_id, '{utility}', '{EPOCH}', {start}, {column} FROM rates "
+                   f"WHERE flat_id IS NOT NULL AND {column} IS NOT NULL AND NOT EXISTS "
+                   f"(SELECT 1 FROM tariff_tiers WHERE tariff_tiers.flat_id = rates.flat_id "
+                   f"AND tariff_tiers.utility = '{utility}' AND tariff_tiers.effective_from = '{EPOCH}' "
+                   f"AND tariff_tiers.start = {start})")
+
+
+def downgrade():
+    op.drop_table('tariff_tiers')
@@ -0,0 +1,113 @@
+"""flats
+
+Revision ID: c7f1d2e84a90
+Revises: 8b5e0f3a6c21
+Create Date: 2026-10-18 12:26:07.530419
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from settings import OWNER_USERNAME, RENTER_USERNAME
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7f1d2e84a90'
+down_revision = '8b5e0f3a6c21'
+branch_labels = None
+depends_on = None
+
+FLAT_TABLES = ['users', 'counters', 'flat_payments', 'rates']
+
+
+def inspector():
+    return sa.inspect(op.get_bind())
+
+
+def existing_columns(table):
+    return {column['name'] for column in inspector().get_columns(table)}
+
+
+def existing_indexes(table):
+    return {index['name'] for index in inspector().get_indexes(table)}
+
+
+def existing_unique_constraints(table):
+    return {constraint['name'] for constraint in inspector().get_unique_constraints(table)}
+
+
+def upgrade():
+    # models.create_all may have created flats table and new indexes already.
+    if 'flats' not in inspector().get_table_names():
+        op.create_table(
+            'flats',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('name', sa.String()),
+            sa.Column('owner_username', sa.String()),
+            sa.Column('renter_username', sa.String()),
+            sa.Column('heating_account', sa.String()),
+        )
+    for name, column in [('ix_flats_owner_username', 'owner_username'),
+                         ('ix_flats_renter_username', 'renter_username')]:
+        if name not in existing_indexes('flats'):
+            op.create_index(name, 'flats', [column])
+
+    # Everything that exists so far belongs to the single flat configured in settings.
+    bind = op.get_bind()
+    flat_id = bind.execute(sa.text('SELECT min(id) FROM flats')).scalar()
+    if not flat_id:
+        bind.execute(sa.text("INSERT INTO flats (name, owner_username, renter_username) "
+                             "VALUES ('default', :owner, :renter)"), owner=OWNER_USERNAME, renter=RENTER_USERNAME)
+        flat_id = bind.execute(sa.text('SELECT min(id) FROM flats')).scalar()
+
+    for table in FLAT_TABLES:
+        if 'flat_id' not in existing_columns(table):
+            with op.batch_alter_table(table) as batch_op:
+                batch_op.add_column(sa.Column('flat_id', sa.Integer()))
+                batch_op.create_foreign_key(f'fk_{table}_flat_id', 'flats', ['flat_id'], ['id'])
+        bind.execute(sa.text(f'UPDATE {table} SET flat_id = :flat_id WHERE flat_id IS NULL'), flat_id=flat_id)
+
+    for name, table, columns in [('ix_users_chat_id', 'users', ['chat_id']),
+                                 ('ix_users_flat_id', 'users', ['flat_id']),
+                                 ('ix_counters_flat_id_updated', 'counters', ['flat_id', 'updated']),
+                                 ('ix_counters_flat_id_created', 'counters', ['flat_id', 'created']),
+                                 ('ix_flat_payments_flat_id_is_paid_year_month', 'flat_payments',
+                                  ['flat_id', 'is_paid', 'year', 'month_number'])]:
+        if name not in existing_indexes(table):
+            op.create_index(name, table, columns)
+
+    for name, table in [('ix_counters_user_id_updated', 'counters'),
+                        ('ix_counters_user_id_created', 'counters'),
+                        ('ix_flat_payments_is_paid_year_month', 'flat_payments')]:
+        if name in existing_indexes(table):
+            op.drop_index(name, table_name=table)
+
+    if '_flat_year_month_uc' not in existing_unique_constraints('flat_payments'):
+        with op.batch_alter_table('flat_payments') as batch_op:
+            batch_op.drop_constraint('_year_month_uc', type_='unique')
+            batch_op.create_unique_constraint('_flat_year_month_uc', ['flat_id', 'year', 'month_number'])
+    if '_rates_flat_uc' not in existing_unique_constraints('rates'):
+        with op.batch_alter_table('rates') as batch_op:
+            batch_op.create_unique_constraint('_rates_flat_uc', ['flat_id'])
+
+
+def downgrade():
+    with op.batch_alter_table('rates') as batch_op:
+        batch_op.drop_constraint('_rates_flat_uc', type_='unique')
+    with op.batch_alter_table('flat_payments') as batch_op:
+        batch_op.drop_constraint('_flat_year_month_uc', type_='unique')
+        batch_op.create_unique_constraint('_year_month_uc', ['year', 'month_number'])
+
+    op.drop_index('ix_flat_payments_flat_id_is_paid_year_month', table_name='flat_payments')
+    op.drop_index('ix_counters_flat_id_created', table_name='counters')
+    op.drop_index('ix_counters_flat_id_updated', table_name='counters')
+    op.drop_index('ix_users_flat_id', table_name='users')
+    op.drop_index('ix_users_chat_id', table_name='users')
+    op.create_index('ix_counters_user_id_updated', 'counters', ['user_id', 'updated'])
+    op.create_index('ix_counters_user_id_created', 'counters', ['user_id', 'created'])
+    op.create_index('ix_flat_payments_is_paid_year_month', 'flat_payments', ['is_paid', 'year', 'month_number'])
+
+    for table in FLAT_TABLES:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('flat_id')
+    op.drop_table('flats')
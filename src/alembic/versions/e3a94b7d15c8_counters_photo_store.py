@@ -0,0 +1,48 @@
+"""counters photo store
+
+Revision ID: e3a94b7d15c8
+Revises: c7f1d2e84a90
+Create Date: 2026-10-18 13:40:12.904385
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3a94b7d15c8'
+down_revision = 'c7f1d2e84a90'
+branch_labels = None
+depends_on = None
+
+COLUMNS = [
+    ('counters', 'gas_counter_photo_file_id'),
+    ('counters', 'gas_counter_photo_path'),
+    ('counters', 'gas_counter_photo_thumb_path'),
+    ('email_outbox', 'attachment_path'),
+]
+
+
+def existing_columns(table):
+    inspector = sa.inspect(op.get_bind())
+    return {column['name'] for column in inspector.get_columns(table)}
+
+
+def existing_tables():
+    return set(sa.inspect(op.get_bind()).get_table_names())
+
+
+def upgrade():
+    # email_outbox is created with all its columns by a later migration when it is missing.
+    for table, column in COLUMNS:
+        if table in existing_tables() and column not in existing_columns(table):
+            op.add_column(table, sa.Column(column, sa.String()))
+
+
+def downgrade():
+    # email_outbox is gone already when the later migration that created it was downgraded.
+    for table, column in reversed(COLUMNS):
+        if table not in existing_tables() or column not in existing_columns(table):
+            continue
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column(column)
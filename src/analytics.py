@@ -0,0 +1,172 @@
+"""Consumption analytics over the whole counters history.
+
+Usage: python analytics.py [flat_id ...]
+
+History is loaded with one query as column arrays, everything else is computed with numpy without Python loops,
+so it is fast enough for all flats at once.
+"""
+import sys
+import time
+
+import numpy as np
+from sqlalchemy import select, extract
+
+import models
+from models import Counters, Rates, TariffTier
+from tariffs import TariffIndex, EPOCH
+
+UTILITIES = ('electricity', 'gas', 'water')
+ROLLING_WINDOW = 3
+
+
+def load_history(flat_ids=None):
+    """Returns counters of the flats as column arrays sorted by flat and month: flat_id, month, electricity, gas, water.
+    Month is year * 12 + month - 1. Missing values are NaN."""
+    month = extract('year', Counters.created) * 12 + extract('month', Counters.created) - 1
+    query = select([Counters.flat_id, month, Counters.electricity, Counters.gas, Counters.water, Counters.id]). \
+        where(Counters.flat_id.isnot(None)).where(Counters.created.isnot(None))
+    if flat_ids:
+        query = query.where(Counters.flat_id.in_(flat_ids))
+
+    # Plain DB-API rows go straight to numpy, wrapping every row in RowProxy costs more than the query itself.
+    # Sorting is done here as well, ORDER BY would walk the index and look up every row separately.
+    rows = models.session.execute(query).cursor.fetchall()
+    table = np.array(rows, dtype=float).reshape(-1, 6)
+    table = table[np.lexsort((table[:, 5], table[:, 1], table[:, 0]))]
+
+    history = {
+        'flat_id': table[:, 0].astype(np.int64),
+        'month': table[:, 1].astype(np.int64),
+    }
+    for i, utility in enumerate(UTILITIES, 2):
+        history[utility] = table[:, i]
+    return history
+
+
+def load_rates_tariffs(flat_ids):
+    """Returns TariffIndex with current rates of the flats as the only version, for flats without tariff versions.
+    Flats without rates get default ones."""
+    rates = {flat_id: Rates() for flat_id in flat_ids.tolist()}
+    if rates:
+        rates.update(models.session.query(Rates.flat_id, Rates).filter(Rates.flat_id.in_(list(rates))))
+    return TariffIndex.from_rows((flat_id, utility, EPOCH, start, price)
+                                 for flat_id, flat_rates in rates.items()
+                                 for utility, tariff in flat_rates.get_tariffs().items()
+                                 for start, price in tariff.tiers)
+
+
+def last_in_month(history):
+    """Keep only the last counters of every flat and month."""
+    flat_id, month = history['flat_id'], history['month']
+    is_last = np.ones(len(month), dtype=bool)
+    is_last[:-1] = (flat_id[1:] != flat_id[:-1]) | (month[1:] != month[:-1])
+    return {name: values[is_last] for name, values in history.items()}
+
+
+def group_starts(flat_id):
+    """Returns index of the first row of the flat for every row."""
+    index = np.arange(len(flat_id))
+    is_first = np.ones(len(flat_id), dtype=bool)
+    is_first[1:] = flat_id[1:] != flat_id[:-1]
+    return np.maximum.accumulate(np.where(is_first, index, 0)) if len(flat_id) else index
+
+
+def deltas(values, starts):
+    """Difference with the previous counters of the same flat. NaN for the first counters of the flat."""
+    result = np.full(len(values), np.nan)
+    result[1:] = values[1:] - values[:-1]
+    result[starts == np.arange(len(values))] = np.nan
+    return result
+
+
+def rolling_mean(values, starts, window):
+    """Mean of the last `window` values of the same flat, NaN are skipped."""
+    valid = ~np.isnan(values)
+    sums = np.concatenate(([0.], np.cumsum(np.where(valid, values, 0))))
+    counts = np.concatenate(([0], np.cumsum(valid)))
+    index = np.arange(len(values))
+    window_start = np.maximum(index - window + 1, starts)
+    total = sums[index + 1] - sums[window_start]
+    count = counts[index + 1] - counts[window_start]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan)
+
+
+def year_ago_positions(flat_id, month):
+    """Returns row of the same flat 12 months earlier for every row, -1 if there is none."""
+    keys = (flat_id << 32) | month
+    year_ago_keys = keys - 12
+    positions = np.searchsorted(keys, year_ago_keys)
+    found = positions < len(keys)
+    found[found] = keys[positions[found]] == year_ago_keys[found]
+    return np.where(found, positions, -1)
+
+
+def year_over_year(values, positions):
+    """Difference with the value 12 months earlier, NaN if there is none."""
+    year_ago = np.where(positions >= 0, values[positions], np.nan) if len(values) else values
+    return values - year_ago
+
+
+def month_days(month):
+    """First day of year * 12 + month - 1 as datetime64[D]."""
+    return (month - 1970 * 12).astype('datetime64[M]').astype('datetime64[D]')
+
+
+def utility_costs(utility, flat_id, month, amounts, tariffs, rates_tariffs):
+    """Cost of every row by the tariff version in effect in its month, current rates where there was none."""
+    days = month_days(month)
+    costs = tariffs.cost_many(utility, flat_id, days, amounts)
+    missing = np.isnan(costs) & ~np.isnan(amounts)
+    if missing.any():
+        costs[missing] = rates_tariffs.cost_many(utility, flat_id[missing], days[missing], amounts[missing])
+    return costs
+
+
+@models.with_session
+def consumption(flat_ids=None, window=ROLLING_WINDOW):
+    """Returns monthly consumption report as column arrays, one row per flat and month:
+    flat_id, month, months (since previous counters), <utility>, <utility>_avg, <utility>_yoy,
+    <utility>_cost, cost and cost_yoy. Costs use tariff versions in effect in that month."""
+    history = last_in_month(load_history(flat_ids))
+    flat_id, month = history['flat_id'], history['month']
+    starts = group_starts(flat_id)
+    year_ago = year_ago_positions(flat_id, month)
+
+    months = deltas(month.astype(float), starts)
+    report = {'flat_id': flat_id, 'month': month, 'months': months}
+    for utility in UTILITIES:
+        report[utility] = deltas(history[utility], starts)
+        report[f'{utility}_avg'] = rolling_mean(report[utility], starts, window)
+        report[f'{utility}_yoy'] = year_over_year(report[utility], year_ago)
+
+    tariffs, rates_tariffs = TariffTier.get_index(), load_rates_tariffs(np.unique(flat_id))
+    for utility in UTILITIES:
+        report[f'{utility}_cost'] = utility_costs(utility, flat_id, month, report[utility], tariffs, rates_tariffs)
+    report['cost'] = report['electricity_cost'] + report['gas_cost'] + report['water_cost']
+    report['cost_yoy'] = year_over_year(report['cost'], year_ago)
+    return report
+
+
+def format_month(month):
+    return f'{month // 12}-{month % 12 + 1:02d}'
+
+
+def flat_report_rows(report, flat_id, last=12):
+    """Returns last months of the flat as table rows: month, electricity, gas, water, cost, cost year over year."""
+    rows = np.flatnonzero(report['flat_id'] == flat_id)[-last:]
+    columns = ('electricity', 'gas', 'water', 'cost', 'cost_yoy')
+    return [[format_month(int(report['month'][i]))] +
+            ['' if np.isnan(report[column][i]) else round(float(report[column][i]), 1) for column in columns]
+            for i in rows]
+
+
+if __name__ == '__main__':
+    started = time.perf_counter()
+    result = consumption([int(flat_id) for flat_id in sys.argv[1:]] or None)
+    elapsed = time.perf_counter() - started
+
+    flats = np.unique(result['flat_id'])
+    print(f'{len(result["month"])} flat months of {len(flats)} flats in {elapsed * 1000:.1f} ms')
+    for flat_id in flats[:10]:
+        print(f'Flat {flat_id}: ' + ', '.join(f'{row[0]} {row[4]}' for row in flat_report_rows(result, flat_id, 3)))
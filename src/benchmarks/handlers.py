@@ -0,0 +1,214 @@
+"""End-to-end latency of the bot handlers.
+
+Usage: python -m benchmarks.handlers [--iterations N] [--save PATH] [--compare PATH] [--max-regression 0.25]
+
+Synthetic updates go through main.conversation_handler() on a dispatcher without workers, against in-memory SQLite.
+Telegram, exchange rate and heating calls are stubbed. For every step it reports p50/p95/p99 latency,
+DB queries made by the handler itself and peak memory allocated while handling the update (measured in a separate
+pass, tracing slows handlers down). --save writes JSON baseline, --compare prints the difference with one and
+exits with code 1 if p50 of any step got slower than --max-regression.
+"""
+import argparse
+import itertools
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from queue import Queue
+
+os.environ.update(DB_URL='sqlite://', OWNER='bench_owner', RENTER='bench_renter', PHOTO_WORKERS='1',
+                  PHOTO_STORE_DIR=tempfile.mkdtemp(prefix='bench-photos-'), PERSISTENCE_PATH='')
+
+import telegram
+from sqlalchemy import event
+from telegram.ext import Dispatcher
+
+import heating
+import helpers
+import main
+import models
+import photos
+
+OWNER_ID, RENTER_ID = 2, 1
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'handlers_baseline.json')
+
+_ids = itertools.count(1000)
+
+
+class FakeRequest:
+    """Telegram Bot API stub. Answers like Telegram would, without network."""
+
+    con_pool_size = 8
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        if method == 'getFile':
+            return {'file_id': data['file_id'], 'file_unique_id': data['file_id'], 'file_size': 1,
+                    'file_path': f"photos/{data['file_id']}.jpg"}
+        if method.startswith('send'):
+            return {'message_id': next(_ids), 'date': int(time.time()), 'text': data.get('text'),
+                    'chat': {'id': data['chat_id'], 'type': 'private'}}
+        return True
+
+    def retrieve(self, url, timeout=None):
+        return b'\xff\xd8' + url.encode()
+
+
+bot = telegram.Bot('123:BENCH', request=FakeRequest())
+bot._bot = telegram.User(0, 'bench', True, username='bench_bot')
+
+
+def make_update(user_id, username, text=None, photo=False):
+    message = {'message_id': next(_ids), 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'},
+               'from': {'id': user_id, 'is_bot': False, 'first_name': username, 'username': username}}
+    if photo:
+        message['photo'] = [{'file_id': f'small{message["message_id"]}', 'file_unique_id': 's', 'width': 90,
+                             'height': 90},
+                            {'file_id': f'big{message["message_id"]}', 'file_unique_id': 'b', 'width': 900,
+                             'height': 900}]
+    else:
+        message['text'] = text
+    return telegram.Update.de_json({'update_id': next(_ids), 'message': message}, bot)
+
+
+class QueryCounter:
+    """Counts DB queries made by the thread that handles the update."""
+
+    def __init__(self, engine):
+        self.count = 0
+        self.thread = threading.get_ident()
+        event.listen(engine, 'before_cursor_execute', self.on_execute)
+
+    def on_execute(self, *args):
+        if threading.get_ident() == self.thread:
+            self.count += 1
+
+
+def setup():
+    """Create schema, stub external calls and start conversations for owner and renter."""
+    models.create_schema()
+    helpers.exchange_rate_cache.loader = lambda: 27.5
+    heating.provider.get_bill = lambda period=None, account=None: 850.0
+
+    dispatcher = Dispatcher(bot, Queue(), workers=0, use_context=True)
+    dispatcher.add_handler(main.conversation_handler())
+    models.with_session(models.Flat.get_or_create_default)()
+
+    send(dispatcher, OWNER_ID, 'bench_owner', 'Привет')
+    send(dispatcher, RENTER_ID, 'bench_renter', 'Привет')
+    for month in ('January', 'February'):
+        send(dispatcher, OWNER_ID, 'bench_owner', 'Оплачено')
+        send(dispatcher, OWNER_ID, 'bench_owner', month)
+    return dispatcher
+
+
+def send(dispatcher, user_id, username, text=None, photo=False):
+    dispatcher.process_update(make_update(user_id, username, text, photo))
+
+
+def scenario(i):
+    """Steps of one iteration: (step name, user id, username, text, is photo)."""
+    renter, owner = (RENTER_ID, 'bench_renter'), (OWNER_ID, 'bench_owner')
+    return [
+        ('counters.new', *renter, 'Новые показания', False),
+        ('counters.electricity', *renter, str(1000 + i * 10), False),
+        ('counters.water', *renter, str(500 + i), False),
+        ('counters.gas', *renter, str(300 + i), False),
+        ('counters.photo', *renter, None, True),
+        ('bill', *renter, 'Счет', False),
+        ('prices.renter', *renter, 'Тарифы', False),
+        ('prices.owner', *owner, 'Тарифы', False),
+        ('rates.edit', *owner, f'water: {20 + i % 5}', False),
+        ('payments.calendar', *owner, 'Оплачено', False),
+        ('payments.toggle', *owner, 'March', False),
+    ]
+
+
+def wait_for_background_work():
+    """Photo pipeline has one worker, so an empty task is done after everything submitted before it."""
+    photos.photo_executor.submit(lambda: None).result()
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def run(iterations, warmup=3):
+    dispatcher = setup()
+    queries = QueryCounter(models.engine)
+    latencies, query_counts, peaks = {}, {}, {}
+
+    for i in range(warmup + iterations * 2):
+        tracing = i >= warmup + iterations
+        for name, user_id, username, text, photo in scenario(i):
+            update = make_update(user_id, username, text, photo)
+            if tracing:
+                tracemalloc.start()
+                dispatcher.process_update(update)
+                peaks.setdefault(name, []).append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            else:
+                queries.count = 0
+                started = time.perf_counter()
+                dispatcher.process_update(update)
+                elapsed = time.perf_counter() - started
+                if i >= warmup:
+                    latencies.setdefault(name, []).append(elapsed * 1000)
+                    query_counts.setdefault(name, []).append(queries.count)
+            if photo:
+                wait_for_background_work()
+
+    return {name: {
+        'p50_ms': round(percentile(values, 50), 3),
+        'p95_ms': round(percentile(values, 95), 3),
+        'p99_ms': round(percentile(values, 99), 3),
+        'queries': round(statistics.mean(query_counts[name]), 1),
+        'peak_kib': round(statistics.median(peaks[name]) / 1024, 1),
+    } for name, values in latencies.items()}
+
+
+def print_results(results, baseline=None):
+    print(f"{'step':22} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8} {'peak KiB':>9}")
+    for name, result in results.items():
+        line = (f"{name:22} {result['p50_ms']:8.2f} {result['p95_ms']:8.2f} {result['p99_ms']:8.2f} "
+                f"{result['queries']:8.1f} {result['peak_kib']:9.1f}")
+        if baseline and name in baseline:
+            change = result['p50_ms'] / baseline[name]['p50_ms'] - 1 if baseline[name]['p50_ms'] else 0
+            line += f"  p50 {change:+.0%}, queries {result['queries'] - baseline[name]['queries']:+.1f}"
+        print(line)
+
+
+def regressions(results, baseline, max_regression):
+    return [name for name, result in results.items()
+            if name in baseline and result['p50_ms'] > baseline[name]['p50_ms'] * (1 + max_regression)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--save', nargs='?', const=DEFAULT_BASELINE, help='write results as JSON baseline')
+    parser.add_argument('--compare', nargs='?', const=DEFAULT_BASELINE, help='compare with JSON baseline')
+    parser.add_argument('--max-regression', type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = run(args.iterations)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f'Saved to {args.save}')
+    if baseline:
+        slower = regressions(results, baseline, args.max_regression)
+        if slower:
+            print(f"Slower than baseline: {', '.join(slower)}")
+            sys.exit(1)
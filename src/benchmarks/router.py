@@ -0,0 +1,59 @@
+"""Per-update cost of picking the handler in the main menu: regex handler chain vs Router.
+
+Usage: python -m benchmarks.router [iterations]
+"""
+import os
+import sys
+import timeit
+from datetime import datetime
+
+os.environ.setdefault('DB_URL', 'sqlite://')
+
+from telegram import Update, Message, Chat, User
+from telegram.ext import MessageHandler, Filters
+
+import main
+from router import Router
+
+MESSAGES = ['Счетчики', 'Тарифы', 'Счет', 'Шутка', 'Новые показания', 'Меню', 'Оплачено', 'Пока',
+            'Привет, как дела?', 'Покажи Счет пожалуйста', 'Long message without any command in it ' * 5]
+
+
+def make_update(text, update_id=1):
+    user = User(1, 'Bench', False)
+    chat = Chat(1, Chat.PRIVATE)
+    return Update(update_id, message=Message(update_id, user, datetime.now(), chat, text=text))
+
+
+def regex_chain(routes, default):
+    """Handlers the way CHOOSING state was set up before Router."""
+    default_regex_commands = 'Счетчики|Тарифы|Счет|Шутка|Новые показания|Меню|Пока|payments'
+    handlers = [MessageHandler(Filters.regex(text), callback) for text, callback in routes.items()]
+    handlers.append(MessageHandler(Filters.regex(f'^(?!.*({default_regex_commands}))'), default))
+    return handlers
+
+
+def pick_from_chain(handlers, update):
+    for handler in handlers:
+        if handler.check_update(update):
+            return handler.callback
+    return None
+
+
+def run(iterations):
+    routes = main.choosing_routes()
+    chain = regex_chain(routes, main.other_msgs_handler)
+    router = Router(routes, default=main.other_msgs_handler)
+    updates = [make_update(text, i) for i, text in enumerate(MESSAGES)]
+
+    results = {}
+    for name, pick in [('regex chain', lambda u: pick_from_chain(chain, u)), ('router', router.check_update)]:
+        seconds = timeit.timeit(lambda: [pick(update) for update in updates], number=iterations)
+        results[name] = seconds / (iterations * len(updates)) * 1e9
+        print(f'{name:12} {results[name]:8.0f} ns/update')
+    print(f"speedup      {results['regex chain'] / results['router']:8.1f}x")
+    return results
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,60 @@
+"""Cold start time of the bot, measured with `python -X importtime -c "import main"`.
+
+Usage: python -m benchmarks.startup [--runs N] [--budget-ms MS]
+
+Prints median import time of main and the slowest modules. Exits with code 1 if the median is over the budget
+or if one of the modules that should load lazily on first use was imported at startup.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# Loaded on first use only: sending email, fetching bills, statistics, export, scheduler jobs.
+LAZY_MODULES = ('requests', 'sendgrid', 'numpy', 'tabulate', 'apscheduler', 'heating', 'analytics',
+                'xlsxwriter')
+DEFAULT_BUDGET_MS = 800
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(module='main'):
+    """Import module in a fresh interpreter. Returns {module name: (self us, cumulative us)}."""
+    env = dict(os.environ)
+    env.setdefault('DB_URL', 'sqlite://')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=SRC_DIR, env=env,
+                            stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def run(runs, budget_ms):
+    samples = [import_times() for _ in range(runs)]
+    totals = sorted(times['main'][1] / 1000 for times in samples)
+    median = statistics.median(totals)
+    slowest = sorted(samples[-1].items(), key=lambda item: item[1][0], reverse=True)[:10]
+
+    print(f'import main: median {median:.0f} ms, min {totals[0]:.0f} ms, max {totals[-1]:.0f} ms ({runs} runs)')
+    print('slowest modules (self time):')
+    for name, (self_us, cumulative_us) in slowest:
+        print(f'    {self_us / 1000:7.1f} ms  {name}')
+
+    eager = [name for name in LAZY_MODULES if name in samples[-1]]
+    if eager:
+        print(f"imported at startup, should be lazy: {', '.join(eager)}")
+    if median > budget_ms:
+        print(f'over budget: {median:.0f} ms > {budget_ms} ms')
+    return median <= budget_ms and not eager
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=int, default=int(os.getenv('STARTUP_BUDGET_MS', DEFAULT_BUDGET_MS)))
+    args = parser.parse_args()
+    sys.exit(0 if run(args.runs, args.budget_ms) else 1)
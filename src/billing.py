@@ -0,0 +1,227 @@
+"""Month-end billing run: bill every flat at once.
+
+Usage: python billing.py [flat_id ...] [--workers N] [--shard-size N] [--email]
+
+Inputs of all flats are loaded with a few queries: last two counters of every flat with one windowed query, rates,
+last payments and tariff versions in bulk. Exchange rate is fetched once and heating bills of all accounts are
+fetched in parallel. Bills are calculated in shards by a process pool, consumption costs of a shard with
+TariffIndex.cost_many. Bills and emails (--email) are written with one executemany each.
+Flats without paid months are skipped, same as for interactive bills.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime
+
+import models
+from settings import HEATING_POOL_SIZE, SENDGRID_TEMPLATE_ID
+from tariffs import UTILITIES, Tariff, TariffIndex
+
+logger = logging.getLogger(__name__)
+
+# Everything a bill needs, loaded before the shards are calculated. Plain tuples, so it is cheap to send to workers.
+BillInput = namedtuple('BillInput', ('flat_id', 'rates', 'counters_last', 'counters_previous', 'last_payment_date',
+                                     'heating'))
+CountersRow = namedtuple('CountersRow', ('id', 'electricity', 'gas', 'water', 'created', 'gas_counter_photo_url'))
+
+
+class StageTimer:
+    """Wall time of every stage of the run."""
+
+    def __init__(self):
+        self.timings = []
+
+    @contextmanager
+    def __call__(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings.append((name, time.perf_counter() - started))
+
+    def format(self):
+        return ', '.join(f'{name} {seconds:.2f} s' for name, seconds in self.timings)
+
+
+def to_counters_row(row):
+    return CountersRow(row.id, row.electricity, row.gas, row.water, row.created, row.gas_counter_photo_url) \
+        if row else None
+
+
+def fetch_exchange_rate():
+    """Returns exchange rate or None, then flat bills are left pending."""
+    from helpers import get_exchange_rate
+
+    try:
+        return get_exchange_rate()
+    except Exception as e:
+        logger.warning('Could not get exchange rate: %s', e)
+        return None
+
+
+@models.with_session
+def fetch_heating(account):
+    """Returns heating bill of the account or None, then heating of its flats is left pending."""
+    from helpers import get_heating_bill
+
+    try:
+        return get_heating_bill(account)
+    except Exception as e:
+        logger.warning('Could not get heating bill of %s: %s', account or 'default account', e)
+        return None
+
+
+def prefetch_heating(accounts, workers=HEATING_POOL_SIZE):
+    """Returns {account: heating bill or None} fetched in parallel. None account is the default one."""
+    with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='billing-heating') as executor:
+        return dict(zip(accounts, executor.map(fetch_heating, accounts)))
+
+
+@models.with_session
+def load_inputs(flat_ids=None):
+    """Returns [BillInput], skipped flat ids, heating accounts by flat id and tariff rows by flat id."""
+    # Whole tables are read when billing all flats, huge IN lists cost more than the rows of other flats.
+    flats = models.session.query(models.Flat.id, models.Flat.heating_account).order_by(models.Flat.id)
+    tariffs = models.session.query(models.TariffTier.flat_id, models.TariffTier.utility,
+                                   models.TariffTier.effective_from, models.TariffTier.start, models.TariffTier.price)
+    if flat_ids:
+        flats = flats.filter(models.Flat.id.in_(flat_ids))
+        tariffs = tariffs.filter(models.TariffTier.flat_id.in_(flat_ids))
+    accounts = dict(flats.all())
+    flat_ids = list(accounts) if flat_ids else None
+
+    rates = models.Rates.load_all_flat_rates(flat_ids)
+    counters = models.Counters.get_last_and_previous_counters(flat_ids)
+    payments = models.FlatPayment.get_last_payment_dates(flat_ids)
+    tariff_rows = {}
+    for row in tariffs:
+        tariff_rows.setdefault(row[0], []).append(tuple(row))
+
+    inputs, skipped = [], []
+    for flat_id in accounts:
+        if flat_id not in payments:
+            skipped.append(flat_id)
+            continue
+        counters_last, counters_previous = counters.get(flat_id, (None, None))
+        inputs.append(BillInput(flat_id, rates[flat_id], to_counters_row(counters_last),
+                                to_counters_row(counters_previous), payments[flat_id], None))
+    return inputs, skipped, accounts, tariff_rows
+
+
+def calculate_shard(shard, tariff_rows, exchange_rate):
+    """Returns [(flat_id, flat_price, bills)] of the shard. Runs in a worker process, so it doesn't touch the DB."""
+    import numpy as np
+
+    index = TariffIndex.from_rows(tariff_rows)
+    differences = [models.Counters.calculate_counters_difference(item.counters_last, item.counters_previous)
+                   for item in shard]
+    flat_ids = np.array([item.flat_id for item in shard], dtype=np.int64)
+    # Consumption is charged by the tariffs in effect when the last counters were sent.
+    days = np.array([(difference[3] or date.today()) for difference in differences], dtype='datetime64[D]')
+
+    costs = {}
+    rates_tariffs = {}
+    for i, utility in enumerate(UTILITIES):
+        amounts = np.array([difference[i] for difference in differences], dtype=float)
+        costs[utility] = index.cost_many(utility, flat_ids, days, amounts)
+        # Flats without tariff versions yet are charged by their rates. Most flats share them, so do the tariffs.
+        for position in np.flatnonzero(np.isnan(costs[utility])):
+            tiers = tuple(shard[position].rates.get_tiers()[utility])
+            if tiers not in rates_tariffs:
+                rates_tariffs[tiers] = Tariff.from_tiers(tiers)
+            costs[utility][position] = rates_tariffs[tiers].cost(amounts[position])
+
+    results = []
+    for position, (item, difference) in enumerate(zip(shard, differences)):
+        flat_price = item.rates.get_flat_price()
+        bills = item.rates.calculate_total_price(
+            flat_price, exchange_rate, difference, item.last_payment_date, item.heating,
+            costs={utility: float(costs[utility][position]) for utility in UTILITIES})
+        results.append((item.flat_id, flat_price, bills))
+    return results
+
+
+def calculate_bills(inputs, tariff_rows, exchange_rate, workers, shard_size):
+    """Returns [(flat_id, flat_price, bills)] of all inputs. Shards go to a process pool when there is more than one."""
+    shards = [inputs[i:i + shard_size] for i in range(0, len(inputs), shard_size)]
+    shard_args = [(shard, [row for item in shard for row in tariff_rows.get(item.flat_id, ())], exchange_rate)
+                  for shard in shards]
+    if workers <= 1 or len(shards) <= 1:
+        return [result for args in shard_args for result in calculate_shard(*args)]
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(shards))) as executor:
+        futures = [executor.submit(calculate_shard, *args) for args in shard_args]
+        return [result for future in futures for result in future.result()]
+
+
+def email_data(item, bill_row):
+    """Email for sendgrid dynamic template, same as the one sent with new counters."""
+    from helpers import bill_email_template
+
+    template_data = bill_email_template(item.counters_last or CountersRow(None, None, None, None, None, None),
+                                        item.rates, models.BillSnapshot(**bill_row))
+    return {'subject': f'Счет за {datetime.now():%m.%Y}', 'template_id': SENDGRID_TEMPLATE_ID,
+            'template_data': template_data}
+
+
+@models.with_session
+def save_results(inputs, results, exchange_rate, with_emails=False, reason=models.BillSnapshot.BILLING):
+    """Insert bills and optionally emails of the results. Returns number of emails."""
+    inputs = {item.flat_id: item for item in inputs}
+    rows = [models.BillSnapshot.to_row(flat_id, inputs[flat_id].rates.version, flat_price, exchange_rate, bills,
+                                       reason,
+                                       inputs[flat_id].counters_last.id if inputs[flat_id].counters_last else None)
+            for flat_id, flat_price, bills in results]
+    models.BillSnapshot.save_many(rows)
+
+    if not with_emails:
+        return 0
+    emails = [email_data(inputs[row['flat_id']], row) for row in rows]
+    models.EmailOutbox.enqueue_many(emails)
+    return len(emails)
+
+
+def run(flat_ids=None, workers=None, shard_size=5000, with_emails=False, reason=models.BillSnapshot.BILLING):
+    """Bill the flats, all of them by default. Returns number of bills, skipped flat ids and StageTimer."""
+    stage = StageTimer()
+    with stage('load'):
+        inputs, skipped, accounts, tariff_rows = load_inputs(flat_ids)
+    with stage('exchange rate'):
+        exchange_rate = fetch_exchange_rate()
+    with stage('heating'):
+        heating = prefetch_heating(sorted({accounts[item.flat_id] for item in inputs}, key=str))
+        inputs = [item._replace(heating=heating[accounts[item.flat_id]]) for item in inputs]
+    with stage('calculate'):
+        results = calculate_bills(inputs, tariff_rows, exchange_rate, workers or os.cpu_count() or 1, shard_size)
+    with stage('write'):
+        save_results(inputs, results, exchange_rate, with_emails, reason)
+    return len(results), skipped, stage
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('flat_ids', nargs='*', type=int, help='all flats by default')
+    parser.add_argument('--workers', type=int, help='calculating processes, number of CPUs by default')
+    parser.add_argument('--shard-size', type=int, default=5000, help='flats per process pool task')
+    parser.add_argument('--email', action='store_true', help='put bill email of every flat to the outbox')
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    started = time.perf_counter()
+    billed, skipped, stage = run(args.flat_ids or None, args.workers, args.shard_size, args.email)
+    elapsed = time.perf_counter() - started
+
+    print(f'Billed {billed} flats in {elapsed:.1f} s ({billed / max(elapsed, 1e-9):.0f} flats/s): {stage.format()}')
+    if skipped:
+        print(f'Skipped {len(skipped)} flats without paid months: {", ".join(map(str, skipped[:20]))}'
+              f'{" ..." if len(skipped) > 20 else ""}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+import logging
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """Process-wide cache for values produced by a loader function.
+
+    Values younger than ``ttl`` seconds are served from memory. Older values are still
+    served while a background thread reloads them (stale-while-revalidate). When the
+    reload fails the last known good value is kept, so a slow or broken upstream never
+    blocks readers once the cache is warm.
+    """
+
+    def __init__(self, loader, ttl, name=None):
+        self.loader = loader
+        self.ttl = ttl
+        self.name = name or loader.__name__
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0, 'refresh_errors': 0}
+
+    @property
+    def stats(self):
+        """Return copy of hit/miss/refresh counters."""
+        with self._lock:
+            return dict(self._stats)
+
+    def get(self, *key):
+        """Return cached value for key, load it on the first call."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, loaded_at = entry
+                if time.monotonic() - loaded_at < self.ttl:
+                    self._count('hits')
+                else:
+                    self._count('stale_hits')
+                    self._refresh_in_background(key)
+                return value
+            self._count('misses')
+
+        value = self.loader(*key)
+        self.set(value, *key)
+        return value
+
+    def peek(self, *key):
+        """Return cached value (even stale one) without loading it. None if missing."""
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry[0] if entry else None
+
+    def set(self, value, *key):
+        """Store value for key."""
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+
+    def invalidate(self, *key):
+        """Drop value for key. Drop everything when key is omitted."""
+        with self._lock:
+            if key:
+                self._entries.pop(key, None)
+            else:
+                self._entries.clear()
+
+    def _count(self, event):
+        """Count event here and in metrics.CACHE_EVENTS. Must hold the lock."""
+        self._stats[event] += 1
+        metrics.registry.inc(metrics.CACHE_EVENTS, cache=self.name, event=event)
+
+    def _refresh_in_background(self, key):
+        """Start reload thread unless one is already running for key. Must hold the lock."""
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+        thread = threading.Thread(target=self._refresh, args=(key,), name=f'{self.name}-refresh', daemon=True)
+        thread.start()
+
+    def _refresh(self, key):
+        try:
+            value = self.loader(*key)
+        except Exception as e:
+            with self._lock:
+                self._count('refresh_errors')
+            logger.warning('Could not refresh %s cache, keeping last known value: %s', self.name, e)
+        else:
+            self.set(value, *key)
+            with self._lock:
+                self._count('refreshes')
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+
+class Registry:
+    """Process-wide map of every row of a small table, e.g. users.
+
+    Warmed once with all values from the loader, then kept current by the writers with ``set``.
+    Nothing expires, so it only suits tables that are written through this process.
+    """
+
+    def __init__(self, loader, key, name=None):
+        self.loader = loader
+        self.key = key
+        self.name = name or loader.__name__
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def warm(self):
+        """Replace entries with everything the loader returns."""
+        entries = {self.key(value): value for value in self.loader()}
+        with self._lock:
+            self._entries = entries
+        logger.info('Loaded %s %s into registry', len(entries), self.name)
+
+    def get(self, key):
+        """Return value for key or None."""
+        with self._lock:
+            return self._entries.get(key)
+
+    def set(self, value):
+        """Store value under its key."""
+        with self._lock:
+            self._entries[self.key(value)] = value
+
+
+class RenderCache:
+    """Process-wide cache of rendered messages by key and kind, e.g. flat id and 'counters'.
+
+    Every key has a data version. Writers bump it when data behind the messages of the key changes, which drops
+    them. Messages are also dropped after ``ttl`` seconds, to catch changes made outside this process.
+    """
+
+    def __init__(self, ttl, name=None):
+        self.ttl = ttl
+        self.name = name or 'render'
+        self._versions = {}
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    @property
+    def stats(self):
+        """Return copy of hit/miss counters."""
+        with self._lock:
+            return dict(self._stats)
+
+    def get(self, key, kind, render):
+        """Return message of the kind for key, render() it when missing or outdated."""
+        with self._lock:
+            version = self._versions.get(key, 0)
+            entry = self._entries.get(key, {}).get(kind)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self._count('hits')
+                return entry[1]
+            self._count('misses')
+
+        value = render()
+        with self._lock:
+            # Data could change while rendering, then the message is outdated already.
+            if self._versions.get(key, 0) == version:
+                self._entries.setdefault(key, {})[kind] = (time.monotonic(), value)
+        return value
+
+    def _count(self, event):
+        """Count event here and in metrics.CACHE_EVENTS. Must hold the lock."""
+        self._stats[event] += 1
+        metrics.registry.inc(metrics.CACHE_EVENTS, cache=self.name, event=event)
+
+    def bump(self, key):
+        """Data of the key changed: drop its messages."""
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self._entries.pop(key, None)
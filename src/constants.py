@@ -3,7 +3,7 @@ CALENDAR_STATE, EDIT_COUNTERS_DATA, UPDATE_RATES = range(11)
 ELECTRICITY = 'electricity'
 WATER = 'water'
 GAS = 'gas'
-GAS_COUNTER_PHOTO = 'gas_counter_photo_url'
+GAS_COUNTER_PHOTO = 'gas_counter_photo_file_id'
 EDIT_ENERGY = 'edit_energy'
 EDIT_WATER = 'edit_water'
 EDIT_GAS = 'edit_gas'
@@ -1,38 +1,80 @@
-from functools import wraps
+from functools import wraps, partial
 
 from telegram import ChatAction
+from telegram.ext import Dispatcher
 
 import models
 from constants import ELECTRICITY_STATE, GAS_STATE, WATER_STATE, ELECTRICITY, CHOOSING, WATER, GAS, \
     GAS_COUNTER_PHOTO_STATE, GAS_COUNTER_PHOTO
 from helpers import validate_new_counters_data
+from sender import reply, send_chat_action
 
 states = [ELECTRICITY_STATE, WATER_STATE, GAS_STATE, GAS_COUNTER_PHOTO_STATE]
 
+NO_FLAT_MSG = 'Квартира не найдена. Попросите владельца добавить вас.'
+
 
 def send_typing_action(func):
     """Sends typing action while processing func command."""
 
     @wraps(func)
     def command_func(update, context, *args, **kwargs):
-        context.bot.send_chat_action(chat_id=update.effective_message.chat_id, action=ChatAction.TYPING)
+        send_chat_action(update, ChatAction.TYPING)
         return func(update, context, *args, **kwargs)
 
     return command_func
 
 
+def run_async(func):
+    """Runs func in the dispatcher worker pool (UPDATER_WORKERS threads), so a slow handler doesn't hold updates
+    of other users. Conversation moves to the returned state once func is done, messages of the user that come
+    meanwhile go to the ConversationHandler.WAITING handlers. Without workers func runs inline."""
+
+    @wraps(func)
+    def async_func(*args, **kwargs):
+        dispatcher = Dispatcher.get_instance()
+        if not dispatcher.workers:
+            return func(*args, **kwargs)
+        return dispatcher.run_async(func, *args, **kwargs)
+
+    # Lets wrappers like metrics.timed_handler wrap func itself and run the result in the pool again.
+    async_func.run_async = run_async
+    return async_func
+
+
+def flat_required(func):
+    """Resolves flat of the chat and passes it to func as flat kwarg. Users without a flat get a notice."""
+
+    @wraps(func)
+    def command_func(update, context, *args, **kwargs):
+        chat_id = update.effective_chat.id
+        flat = models.Flat.get_by_chat_id(chat_id)
+        # Flat could be added after the user wrote first, then registering attaches the user to it.
+        if not flat and models.User.register(update.effective_user, chat_id).flat_id is not None:
+            flat = models.Flat.get_by_chat_id(chat_id)
+
+        if not flat:
+            reply(update, NO_FLAT_MSG)
+            return CHOOSING
+        return func(update, context, *args, flat=flat, **kwargs)
+
+    return command_func
+
+
 def set_utility_data(option):
     _option = option
 
     def decorator(function):
         @wraps(function)
-        def wrapper(*args, **kwargs):
+        @flat_required
+        def wrapper(*args, flat):
             """Validates and updates counters data."""
             update, context = args
             new_value = update.message.text
             user_id = update.effective_user.id
             current_state, msg = get_state(_option)
-            return process_counters_data(*args, _option, new_value, user_id, function, current_state, msg)
+            return process_counters_data(*args, _option, new_value, user_id, flat.id, partial(function, flat=flat),
+                                         current_state, msg)
         return wrapper
     return decorator
 
@@ -56,18 +98,17 @@ def get_state(option, current_state=None, next_msg='Отлично. Теперь
 
 def process_counters_data(*args):
     """Handle new counters data."""
-    update, context, _option, new_value, user_id, function, current_state, msg = args
+    update, context, _option, new_value, user_id, flat_id, function, current_state, msg = args
 
     try:
         if current_state is not GAS_COUNTER_PHOTO_STATE:
-            previous_counter_data = models.Counters.get_last_user_counters(user_id)
+            previous_counter_data = models.Counters.get_last_flat_counters(flat_id)
             previous_value = getattr(previous_counter_data, _option, None)
             validated_value = validate_new_counters_data(new_value, previous_value)
         else:
-            received_photo = update.message.photo[-1]
-            img = received_photo.get_file()
-            validated_value = img.file_path
-        set_counters_data(validated_value, _option, user_id)
+            # Photo itself is downloaded in background by photos.submit_counters_photo.
+            validated_value = update.message.photo[-1].file_id
+        set_counters_data(validated_value, _option, user_id, flat_id)
     except (TypeError, ValueError) as e:
         if new_value == 'Меню':
             msg = '>>'
@@ -91,13 +132,14 @@ def get_next_state(current_state):
     return state
 
 
-def set_counters_data(validated_value, option, user_id):
+def set_counters_data(validated_value, option, user_id, flat_id):
     """Set counters new value."""
-    counters = models.Counters.get_current_month_counters_data(user_id)
+    counters = models.Counters.get_current_month_counters_data(flat_id)
 
     if not counters:
         counters = models.Counters()
         counters.user_id = user_id
+        counters.flat_id = flat_id
 
     setattr(counters, option, validated_value)
     counters.commit()
@@ -0,0 +1,96 @@
+"""Export of counters history, bills and payments of a flat as CSV files or one XLSX workbook.
+
+Rows are streamed from the DB in batches as plain tuples and written to the file as they come,
+so memory doesn't depend on the length of the history.
+"""
+import csv
+import os
+from datetime import datetime, timedelta
+
+import models
+
+FORMATS = ('csv', 'xlsx')
+USAGE_MSG = 'Экспорт [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] [csv|xlsx], например: Экспорт 2019-01-01 2019-12-31 xlsx'
+
+
+def get_payments(flat_id, since, until):
+    """Payments are by month, so the month of the last day is the last one included."""
+    return models.FlatPayment.get_history(flat_id, since, until and until - timedelta(days=1))
+
+
+# name: (headers, function(flat_id, since, until) returning rows)
+DATASETS = {
+    'counters': (('created', 'electricity', 'gas', 'water'), models.Counters.get_history),
+    'bills': (('created', 'reason', 'flat_price', 'exchange_rate', *models.BillSnapshot.BILL_FIELDS, 'pending'),
+              models.BillSnapshot.get_history),
+    'payments': (('year', 'month', 'is_paid'), get_payments),
+}
+
+
+def parse_args(text):
+    """Parse 'Экспорт [from] [to] [csv|xlsx]'. Dates are YYYY-MM-DD, both inclusive.
+    Returns since, until (exclusive, day after the last one) and format. Raises ValueError."""
+    since = until = None
+    file_format = 'csv'
+
+    for arg in text.split()[1:]:
+        if arg.lower() in FORMATS:
+            file_format = arg.lower()
+        elif since is None:
+            since = datetime.strptime(arg, '%Y-%m-%d')
+        elif until is None:
+            until = datetime.strptime(arg, '%Y-%m-%d') + timedelta(days=1)
+        else:
+            raise ValueError(arg)
+    if since and until and since >= until:
+        raise ValueError('empty range')
+    return since, until, file_format
+
+
+def write_csv(path, headers, rows):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        writer.writerows(rows)
+
+
+def write_xlsx(path, datasets):
+    """Write every (name, headers, rows) to its own sheet. Rows are flushed to disk one by one."""
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    date_format = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm'})
+    try:
+        for name, headers, rows in datasets:
+            sheet = workbook.add_worksheet(name)
+            sheet.write_row(0, 0, headers)
+            for row_number, row in enumerate(rows, 1):
+                for column, value in enumerate(row):
+                    if isinstance(value, datetime):
+                        sheet.write_datetime(row_number, column, value.replace(tzinfo=None), date_format)
+                    else:
+                        sheet.write(row_number, column, value)
+    finally:
+        workbook.close()
+
+
+@models.with_session
+def export_flat(flat_id, directory, since=None, until=None, file_format='csv'):
+    """Write history of the flat to directory. Returns paths of the written files."""
+    prefix = f'flat{flat_id}'
+    if since or until:
+        last_day = until - timedelta(days=1) if until else None
+        prefix += f"_{since.date() if since else ''}-{last_day.date() if last_day else ''}"
+
+    datasets = ((name, headers, get_rows(flat_id, since, until)) for name, (headers, get_rows) in DATASETS.items())
+    if file_format == 'xlsx':
+        path = os.path.join(directory, f'{prefix}.xlsx')
+        write_xlsx(path, datasets)
+        return [path]
+
+    paths = []
+    for name, headers, rows in datasets:
+        path = os.path.join(directory, f'{prefix}_{name}.csv')
+        write_csv(path, headers, rows)
+        paths.append(path)
+    return paths
@@ -0,0 +1,105 @@
+import threading
+import time
+from datetime import datetime
+
+import requests as r
+from requests.adapters import HTTPAdapter
+
+import metrics
+import models
+from settings import HEATING_LOGIN, HEATING_PASSWORD, HEATING_LOGIN_API, HEATING_BILL_API, HEATING_PROVIDER_ID, \
+    HEATING_ACCOUNT, HEATING_TOKEN_TTL, HEATING_TIMEOUT, HEATING_POOL_SIZE
+
+
+class HeatingProvider:
+    """Client for the local heating service.
+
+    Auth token is reused until HEATING_TOKEN_TTL passes or the service rejects it. Default account is the first
+    one of the login, flats with their own heating account pass it explicitly.
+    Requests go through one keep-alive session. Bill is fetched once per account and
+    billing month, then served from memory or from the heating_bills table. Bills of different accounts are fetched
+    in parallel.
+    """
+
+    def __init__(self, login, password, login_api, bill_api, provider_id, account=None,
+                 token_ttl=3600, timeout=10, pool_size=2):
+        self.login = login
+        self.password = password
+        self.login_api = login_api
+        self.bill_api = bill_api
+        self.provider_id = provider_id
+        self.account = account
+        self.token_ttl = token_ttl
+        self.timeout = timeout
+        self.http = r.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+        self._token = None
+        self._token_expires_at = 0
+        self._bills = {}
+        self._bill_locks = {}
+        self._lock = threading.Lock()
+
+    def get_bill(self, period=None, account=None):
+        """Return sum to pay for billing period (year, month). Current month and default account by default."""
+        if not period:
+            now = datetime.now()
+            period = (now.year, now.month)
+
+        if not account and not self.account:
+            self._authorize()
+        account = account or self.account
+        key = (account, *period)
+
+        with self._lock:
+            bill_lock = self._bill_locks.setdefault(key, threading.Lock())
+        with bill_lock:
+            if key not in self._bills:
+                bill = models.HeatingBill.get_sum_topay(*key)
+                if bill is None:
+                    bill = self._fetch_bill(account)
+                    models.HeatingBill.save(*key, bill)
+                self._bills[key] = bill
+            return self._bills[key]
+
+    def _authorize(self, force=False):
+        """Login unless there is a valid token already."""
+        with self._lock:
+            if not force and self._token and time.monotonic() < self._token_expires_at:
+                return self._token
+
+            payload = {'email': self.login, 'password': self.password}
+            with metrics.timer(metrics.HTTP_REQUEST_DURATION, upstream='heating'):
+                login_response = self.http.post(self.login_api, data=payload, timeout=self.timeout)
+
+            if login_response.status_code > 200:
+                raise r.exceptions.HTTPError
+            login_response = login_response.json()
+            self._token = login_response['token']
+            self._token_expires_at = time.monotonic() + self.token_ttl
+            if not self.account:
+                self.account = login_response['account'][0]['Code']
+            return self._token
+
+    def _fetch_bill(self, account):
+        """Grab bill, login again once if token was rejected."""
+        bill_response = self._post_bill(self._authorize(), account)
+
+        if bill_response.status_code in (401, 403):
+            bill_response = self._post_bill(self._authorize(force=True), account)
+        if bill_response.status_code > 200:
+            raise r.exceptions.HTTPError
+        bill_response = bill_response.json()
+        return bill_response['dataset'][0]['sum_topay']
+
+    def _post_bill(self, auth_token, account):
+        headers = {'Authorization': auth_token}
+        data = {'account': account, 'provider_id': self.provider_id}
+        with metrics.timer(metrics.HTTP_REQUEST_DURATION, upstream='heating'):
+            return self.http.post(self.bill_api, json=data, headers=headers, timeout=self.timeout)
+
+
+provider = HeatingProvider(HEATING_LOGIN, HEATING_PASSWORD, HEATING_LOGIN_API, HEATING_BILL_API, HEATING_PROVIDER_ID,
+                           account=HEATING_ACCOUNT, token_ttl=HEATING_TOKEN_TTL, timeout=HEATING_TIMEOUT,
+                           pool_size=HEATING_POOL_SIZE)
@@ -1,7 +1,23 @@
-import requests as r
-
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from datetime import datetime
+
+import metrics
+import models
+from cache import TTLCache
 from mail import send_email
-from settings import HEATING_LOGIN, HEATING_PASSWORD, HEATING_LOGIN_API, HEATING_BILL_API, HEATING_PROVIDER_ID
+from settings import EXCHANGE_RATE_API, EXCHANGE_RATE_TTL, EXCHANGE_RATE_TIMEOUT, EXCHANGE_RATE_DEADLINE, \
+    HEATING_DEADLINE, BILL_WORKERS, BILL_PENDING_RETRY
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'ожидается'
+PENDING_LABELS = {'flat': 'квартира', 'heating': 'отопление'}
+
+bill_executor = ThreadPoolExecutor(max_workers=BILL_WORKERS, thread_name_prefix='bill')
+# flat_id: monotonic time when the last bill of the flat was saved with pending bills.
+pending_since = {}
 
 
 def build_menu(buttons,
@@ -17,21 +33,42 @@ def build_menu(buttons,
     return menu
 
 
-def rates_template(rates):
-    """Generate current rates template."""
-    electricity_before = f"<b>Электричество до 100 кВт:</b> {rates.electricity_before_100} грн. \n"
-    electricity_after = f"<b>Электричество после 100 кВт:</b> {rates.electricity_after_100} грн. \n"
-    gas = f"<b>Газ:</b> {rates.gas} грн. \n"
-    water = f"<b>Вода:</b> {rates.water} грн.\n"
+def tariff_template(label, unit, tariff, end=" \n"):
+    """One line per tier: 'до 100', '100-250', 'после 250'. Single tier tariff is just the price."""
+    if len(tariff.starts) == 1:
+        return f"<b>{label}:</b> {tariff.prices[0]} грн.{end}"
+
+    lines = []
+    for i, (start, price) in enumerate(tariff.tiers):
+        if i == 0:
+            amount = f"до {tariff.starts[1]:g}"
+        elif i == len(tariff.starts) - 1:
+            amount = f"после {start:g}"
+        else:
+            amount = f"{start:g}-{tariff.starts[i + 1]:g}"
+        lines.append(f"<b>{label} {amount} {unit}:</b> {price} грн.{end}")
+    return ''.join(lines)
+
+
+def rates_template(rates, tariffs=None):
+    """Generate current rates template. Consumption prices come from tariffs, by default from rates."""
+    tariffs = {**rates.get_tariffs(), **(tariffs or {})}
+    electricity = tariff_template("Электричество", "кВт", tariffs['electricity'])
+    gas = tariff_template("Газ", "м³", tariffs['gas'])
+    water = tariff_template("Вода", "м³", tariffs['water'], end="\n")
     garbage = f"<b>Вывоз мусора:</b> {rates.garbage_removal} грн.\n"
     sdpt = f"<b>СДПТ:</b> {rates.sdpt} грн.\n"
 
-    return f"{electricity_before}{electricity_after}{gas}{water}{garbage}{sdpt}"
+    return f"{electricity}{gas}{water}{garbage}{sdpt}"
 
 
-def get_exchange_rate():
+def fetch_exchange_rate():
     """Call privatbank api to get exchange rates for today."""
-    response = r.get('https://api.privatbank.ua/p24api/pubinfo?json&exchange&coursid=5')
+    import requests as r
+
+    with metrics.timer(metrics.HTTP_REQUEST_DURATION, upstream='privatbank'):
+        response = r.get(EXCHANGE_RATE_API, timeout=EXCHANGE_RATE_TIMEOUT)
+    response.raise_for_status()
     exchange_rate_json = response.json()
 
     for i in exchange_rate_json:
@@ -40,18 +77,92 @@ def get_exchange_rate():
     raise ValueError
 
 
-def calculate_bill(user_id, rates):
-    """Returns fields for a bill."""
+exchange_rate_cache = TTLCache(fetch_exchange_rate, EXCHANGE_RATE_TTL, name='exchange_rate')
+
+
+def get_exchange_rate():
+    """Return cached USD exchange rate. Refreshed in background when older than EXCHANGE_RATE_TTL."""
+    return exchange_rate_cache.get()
+
+
+def wait_for(future, deadline, default=None):
+    """Return future result or default if it is not ready by the deadline (monotonic time)."""
+    try:
+        return future.result(timeout=max(0, deadline - time.monotonic()))
+    except TimeoutError:
+        return default
+    except Exception as e:
+        logger.warning('Bill source failed: %s', e)
+        return default
+
+
+def calculate_bill(flat, rates):
+    """Returns fields for a bill.
+    Exchange rate and heating bill are fetched in background while counters and payments are read from DB.
+    Source that misses its deadline is left pending."""
+    started = time.monotonic()
+    exchange_rate_future = bill_executor.submit(get_exchange_rate)
+    heating_future = bill_executor.submit(models.with_session(get_heating_bill), flat.heating_account)
+
     flat_price = rates.get_flat_price()
-    exchange_rate = get_exchange_rate()
-    bills = rates.calculate_total_price(flat_price, exchange_rate, user_id)
+    counters = models.Counters.get_last_and_previous_flat_counters(flat.id)
+    counters_difference = models.Counters.calculate_counters_difference(*counters)
+    last_payment_date = models.FlatPayment.get_last_payment_date(flat.id)
+    # Consumption is charged by the tariffs in effect when the last counters were sent.
+    tariffs = models.TariffTier.get_flat_tariffs(flat.id, counters_difference[3])
+
+    exchange_rate = wait_for(exchange_rate_future, started + EXCHANGE_RATE_DEADLINE, exchange_rate_cache.peek())
+    heating_bill = wait_for(heating_future, started + HEATING_DEADLINE)
+    bills = rates.calculate_total_price(flat_price, exchange_rate, counters_difference, last_payment_date,
+                                        heating_bill, tariffs)
+    bills['counters_id'] = counters[0].id if counters[0] else None
 
     return flat_price, exchange_rate, bills
 
 
-def bill_template(user_id, rates):
-    """Calculate all data and return template."""
-    flat_price, exchange_rate, bills = calculate_bill(user_id, rates)
+def save_bill_snapshot(flat, rates, reason):
+    """Calculate bill and save it as the latest bill of the flat."""
+    flat_price, exchange_rate, bills = calculate_bill(flat, rates)
+    if bills['pending']:
+        pending_since[flat.id] = time.monotonic()
+    return models.BillSnapshot.save(flat.id, rates.version, flat_price, exchange_rate, bills, reason,
+                                    bills['counters_id'])
+
+
+def refresh_bill_snapshot(flat, rates, reason):
+    """Save new bill after counters, rates or payments of the flat changed."""
+    try:
+        return save_bill_snapshot(flat, rates, reason)
+    except ValueError:
+        logger.warning('Could not calculate bill for flat %s: no paid months yet', flat.id)
+
+
+def is_previous_month(created):
+    """Flat price is seasonal and months since the last payment grow, so bill of a previous month is outdated."""
+    now = datetime.now(created.tzinfo) if created.tzinfo else datetime.utcnow()
+    return (created.year, created.month) < (now.year, now.month)
+
+
+def get_bill_snapshot(flat, rates):
+    """Returns latest bill of the flat.
+    It is calculated again only if there is none yet, it is from a previous month, rates were changed since or some of
+    the bills were pending. Pending bill is calculated again at most once per BILL_PENDING_RETRY seconds, so a broken
+    source isn't asked (and reported) on every press."""
+    snapshot = models.BillSnapshot.get_last(flat.id)
+
+    if snapshot is None or (snapshot.created and is_previous_month(snapshot.created)):
+        return save_bill_snapshot(flat, rates, models.BillSnapshot.REFRESH)
+    if snapshot.rates_version != rates.version:
+        return save_bill_snapshot(flat, rates, models.BillSnapshot.RATES)
+    retry_due = time.monotonic() - pending_since.get(flat.id, float('-inf')) >= BILL_PENDING_RETRY
+    if snapshot.get_pending() and retry_due:
+        return save_bill_snapshot(flat, rates, models.BillSnapshot.REFRESH)
+    return snapshot
+
+
+def bill_template(snapshot):
+    """Return template for the saved bill."""
+    flat_price, exchange_rate, bills = snapshot.flat_price, snapshot.exchange_rate, snapshot.get_bills()
     communal_services = round(bills['sdpt'] + bills['garbage_removal'], 2)
     total = round(bills['total'])
     water = round(bills['water'], 1)
@@ -63,39 +174,52 @@ def bill_template(user_id, rates):
 
     header = "<i>Счет на основе последних и предпоследних показателей счетчиков.</i>\n"
     date = f"<i>Дата последних показаний {last_counters_date}</i> \n\n"
-    flat = f"<b>Квартира:</b> {flat_price} ({exchange_rate})\n"
+    flat = f"<b>Квартира:</b> {flat_price} ({exchange_rate or PENDING})\n"
     services = f"<b>Коммунальные:</b> {communal_services}\n"
     electricity = f"<b>Электричество:</b> {bills['electricity']}\n"
     gas = f"<b>Газ:</b> {bills['gas']} \n"
     water = f"<b>Вода:</b> {water} \n"
-    heating = f"<b>Отопление:</b> {bills['heating']} \n"
+    heating = f"<b>Отопление:</b> {PENDING if bills['heating'] is None else bills['heating']} \n"
     total = f"---------------------------\n {total} грн"
+    if bills['pending']:
+        total += f" (без учета: {', '.join(PENDING_LABELS[k] for k in bills['pending'])})"
     return header + date + flat + services + electricity + gas + water + heating + total
 
 
-def bill_email_template(user_id, counters_last, rates):
-    """Generate bill for sendgrid dynamic template."""
-    flat_price, exchange_rate, bills = calculate_bill(user_id, rates)
+def bill_email_template(counters_last, rates, snapshot):
+    """Generate bill for sendgrid dynamic template from the saved bill."""
+    bills = snapshot.get_bills()
 
     template_data = {
         'electricity_counter': counters_last.electricity,
         'gas_counter': counters_last.gas,
         'gas_counter_photo': counters_last.gas_counter_photo_url,
         'water_counter': counters_last.water,
-        'flat_price': flat_price,
-        'exchange_rate': exchange_rate,
+        'flat_price': snapshot.flat_price,
+        'exchange_rate': snapshot.exchange_rate,
         'sdpt_garbage': round(rates.sdpt + rates.garbage_removal, 2),
         'electricity': bills['electricity'],
         'gas': bills['gas'],
         'water': round(bills['water'], 1),
-        'heating': get_heating_bill(),
+        'heating': bills['heating'],
         'total': round(bills['total'])
     }
     for k, v in template_data.items():
-        template_data[k] = str(v)
+        template_data[k] = PENDING if v is None else str(v)
     return template_data
 
 
+def parse_tiers(text):
+    """Parse '0.9 100:1.68 250:2.1' into [(0, 0.9), (100, 1.68), (250, 2.1)]. Raises ValueError."""
+    tiers = []
+    for i, token in enumerate(text.split()):
+        start, _, price = token.rpartition(':')
+        if bool(start) == (i == 0):
+            raise ValueError(token)
+        tiers.append((float(start or 0), float(price)))
+    return tiers
+
+
 def validate_new_counters_data(value, old_value):
     """Validate value or raise Value error.."""
     value = int(value)
@@ -106,25 +230,12 @@ def validate_new_counters_data(value, old_value):
         raise ValueError
 
 
-def get_heating_bill():
-    """Login to local heating service. Login and grab bill."""
+def get_heating_bill(account=None):
+    """Return heating bill of the account for current month. Send email if it could not be fetched."""
+    import requests as r
+    import heating
+
     try:
-        payload = {'email': HEATING_LOGIN, 'password': HEATING_PASSWORD}
-        login_response = r.post(HEATING_LOGIN_API, data=payload)
-
-        if login_response.status_code > 200:
-            raise r.exceptions.HTTPError
-        login_response = login_response.json()
-        auth_token = login_response['token']
-        account = login_response['account'][0]['Code']
-        headers = {'Authorization': auth_token}
-        data = {'account': account, 'provider_id': HEATING_PROVIDER_ID}
-        bill_response = r.post(HEATING_BILL_API, json=data, headers=headers)
-
-        if bill_response.status_code > 200:
-            raise r.exceptions.HTTPError
-        bill_response = bill_response.json()
-        bill = bill_response['dataset'][0]['sum_topay']
-        return bill
-    except (IndexError, KeyError, r.ConnectionError, r.HTTPError) as e:
+        return heating.provider.get_bill(account=account)
+    except (IndexError, KeyError, r.ConnectionError, r.HTTPError, r.Timeout) as e:
         send_email('Could not get Heating Bill', e)
@@ -0,0 +1,170 @@
+"""Import historical counters readings and payments from CSV or JSONL files.
+
+Usage: python importer.py counters|payments PATH [--flat-id ID] [--format csv|jsonl] [--chunk-size N] [--no-refresh]
+
+Counters columns: flat_id, electricity, gas, water, created, optional updated (defaults to created) and user_id.
+Payments columns: flat_id, year, month_number, is_paid.
+Dates are ISO 8601 local time. flat_id may be left out of the file and given by --flat-id instead.
+
+File is read lazily and written in chunks with bulk mappings, one transaction per chunk, so memory doesn't grow
+with the file. Import is idempotent: counters are matched by (flat_id, created), payments by
+(flat_id, year, month_number), and matching rows are updated instead of inserted again. Rows of unknown flats are
+skipped. Afterwards bills of the imported flats are calculated again unless --no-refresh is given.
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+import models
+
+TRUE_VALUES = ('1', 'true', 'yes', 'y', 't')
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in TRUE_VALUES
+
+
+def parse_datetime(value):
+    return datetime.fromisoformat(value.strip()) if value else None
+
+
+def optional_int(value):
+    return int(value) if value not in (None, '') else None
+
+
+def counters_row(record):
+    created = parse_datetime(record['created'])
+    return {
+        'flat_id': int(record['flat_id']),
+        'electricity': int(record['electricity']),
+        'gas': int(record['gas']),
+        'water': int(record['water']),
+        'created': created,
+        'updated': parse_datetime(record.get('updated')) or created,
+        'user_id': optional_int(record.get('user_id')),
+    }
+
+
+def payments_row(record):
+    return {
+        'flat_id': int(record['flat_id']),
+        'year': int(record['year']),
+        'month_number': int(record['month_number']),
+        'is_paid': parse_bool(record.get('is_paid', True)),
+    }
+
+
+KINDS = {
+    'counters': (models.Counters, counters_row, models.BillSnapshot.COUNTERS),
+    'payments': (models.FlatPayment, payments_row, models.BillSnapshot.PAYMENT),
+}
+
+
+def read_records(path, file_format):
+    """Yields (line number, dict) from CSV with header or from JSON lines."""
+    with open(path, newline='', encoding='utf-8') as f:
+        if file_format == 'csv':
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record
+        else:
+            for line_number, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        yield line_number, json.loads(line)
+                    except ValueError as e:
+                        raise ValueError(f'{path}:{line_number}: bad JSON ({e})') from e
+
+
+def read_rows(path, file_format, to_row, flat_id=None):
+    """Yields model rows. Raises ValueError with the line number for a malformed row."""
+    for line_number, record in read_records(path, file_format):
+        if flat_id is not None and not record.get('flat_id'):
+            record['flat_id'] = flat_id
+        try:
+            yield to_row(record)
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f'{path}:{line_number}: bad row {record!r} ({e!r})') from e
+
+
+@models.with_session
+def import_file(kind, path, file_format=None, flat_id=None, chunk_size=5000, progress=None):
+    """Import the file chunk by chunk. Returns {flat_id: number of rows}, inserted, updated and skipped counts."""
+    model, to_row, _ = KINDS[kind]
+    file_format = file_format or ('csv' if '.csv' in os.path.basename(path) else 'jsonl')
+    known_flats = set(models.Flat.get_flat_ids())
+    flats, inserted, updated, skipped = {}, 0, 0, 0
+
+    rows = read_rows(path, file_format, to_row, flat_id)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        valid = [row for row in chunk if row['flat_id'] in known_flats]
+        skipped += len(chunk) - len(valid)
+        if valid:
+            chunk_inserted, chunk_updated = model.upsert_mappings(valid)
+            inserted += chunk_inserted
+            updated += chunk_updated
+            for row in valid:
+                flats[row['flat_id']] = flats.get(row['flat_id'], 0) + 1
+        if progress:
+            progress(inserted, updated, skipped)
+    return flats, inserted, updated, skipped
+
+
+@models.with_session
+def refresh_bills(flat_ids, reason):
+    """Calculate bills of the flats again, imported rows don't go through the models commit()."""
+    from helpers import refresh_bill_snapshot
+
+    for flat in models.session.query(models.Flat).filter(models.Flat.id.in_(flat_ids)):
+        refresh_bill_snapshot(flat.snapshot(), models.Rates.get_flat_rates(flat.id), reason)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('kind', choices=KINDS)
+    parser.add_argument('path')
+    parser.add_argument('--flat-id', type=int, help='flat of rows without flat_id')
+    parser.add_argument('--format', choices=('csv', 'jsonl'), help='by file extension by default')
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--no-refresh', action='store_true', help="don't calculate bills of imported flats again")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.path):
+        parser.error(f'{args.path} does not exist')
+
+    started = time.perf_counter()
+
+    def progress(inserted, updated, skipped):
+        total = inserted + updated + skipped
+        rate = total / max(time.perf_counter() - started, 1e-9)
+        print(f'\r{args.kind}: {total} rows, {inserted} new, {updated} updated, {skipped} skipped, {rate:.0f} rows/s',
+              end='', file=sys.stderr, flush=True)
+
+    try:
+        flats, inserted, updated, skipped = import_file(args.kind, args.path, args.format, args.flat_id,
+                                                        args.chunk_size, progress)
+    except ValueError as e:
+        print(f'\n{e}', file=sys.stderr)
+        return 1
+    print(file=sys.stderr)
+    print(f'Imported {inserted + updated} {args.kind} rows of {len(flats)} flats in '
+          f'{time.perf_counter() - started:.1f} s ({inserted} new, {updated} updated, {skipped} skipped)')
+
+    if flats and not args.no_refresh:
+        refresh_bills(list(flats), KINDS[args.kind][2])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
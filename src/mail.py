@@ -1,40 +1,89 @@
+import base64
 import logging
+import os
 
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
-
-from settings import FROM_EMAIL, TO_EMAIL, SENDGRID_API_KEY, SENDGRID_TEMPLATE_ID
+import metrics
+import models
+from settings import FROM_EMAIL, TO_EMAIL, SENDGRID_API_KEY, SENDGRID_TEMPLATE_ID, OUTBOX_BATCH_SIZE, \
+    OUTBOX_MAX_ATTEMPTS, OUTBOX_BACKOFF, OUTBOX_MAX_BACKOFF
 
 logger = logging.getLogger(__name__)
 
+_client = None
+
+
+def get_client():
+    """Return SendGrid client shared by all deliveries. Sendgrid is imported on first delivery."""
+    global _client
+    if _client is None:
+        from sendgrid import SendGridAPIClient
+        _client = SendGridAPIClient(SENDGRID_API_KEY)
+    return _client
+
 
 def send_email(subject, body):
-    message = Mail(
-        from_email=FROM_EMAIL,
-        to_emails=TO_EMAIL,
-        subject=subject,
-        html_content=body
-    )
-    try:
-        sg = SendGridAPIClient(SENDGRID_API_KEY)
-        sg.send(message)
-    except Exception as e:
-        logger.exception(e)
+    """Put email to the outbox. It is sent by drain_outbox."""
+    models.EmailOutbox.enqueue(subject, body=str(body))
+
+
+def send_counters_email(template_data, attachment_path=None):
+    """Put email with counters data for Sendgrid dynamic template to the outbox."""
+    models.EmailOutbox.enqueue('Новые данные по коммунальным услугам', template_id=SENDGRID_TEMPLATE_ID,
+                               template_data=template_data, attachment_path=attachment_path)
 
 
-def send_counters_email(template_data):
-    """Send email via Sendgrid."""
+def build_attachment(path):
+    from sendgrid.helpers.mail import Attachment, FileContent, FileName, FileType, Disposition
+
+    with open(path, 'rb') as f:
+        content = base64.b64encode(f.read()).decode()
+    return Attachment(FileContent(content), FileName(os.path.basename(path)), FileType('image/jpeg'),
+                      Disposition('attachment'))
+
+
+def build_message(email):
+    """Build Sendgrid message from the outbox row."""
+    from sendgrid.helpers.mail import Mail
+
     message = Mail(
         from_email=FROM_EMAIL,
         to_emails=TO_EMAIL,
-        subject='Новые данные по коммунальным услугам',
-        html_content='+'
+        subject=email.subject,
+        html_content=email.body or '+'
     )
 
-    message.dynamic_template_data = template_data
-    message.template_id = SENDGRID_TEMPLATE_ID
-    try:
-        sg = SendGridAPIClient(SENDGRID_API_KEY)
-        sg.send(message)
-    except Exception as e:
-        logger.exception(e)
+    if email.template_id:
+        message.dynamic_template_data = email.get_template_data()
+        message.template_id = email.template_id
+    if email.attachment_path and os.path.exists(email.attachment_path):
+        message.attachment = build_attachment(email.attachment_path)
+    return message
+
+
+@models.with_session
+def drain_outbox():
+    """Send due emails from the outbox in batches. Failed ones are retried with backoff, then dead-lettered."""
+    sent = failed = 0
+
+    while True:
+        emails = models.EmailOutbox.get_due(OUTBOX_BATCH_SIZE)
+        if not emails:
+            break
+
+        for email in emails:
+            try:
+                message = build_message(email)
+                with metrics.timer(metrics.HTTP_REQUEST_DURATION, upstream='sendgrid'):
+                    get_client().send(message)
+            except Exception as e:
+                email.mark_failed(e, OUTBOX_MAX_ATTEMPTS, OUTBOX_BACKOFF, OUTBOX_MAX_BACKOFF)
+                failed += 1
+                if email.status == models.EmailOutbox.DEAD:
+                    logger.error('Email %s moved to dead letters after %s attempts: %s', email.id, email.attempts, e)
+            else:
+                email.mark_sent()
+                sent += 1
+        models.session.commit()
+
+    if sent or failed:
+        logger.info('Outbox drained: %s sent, %s failed', sent, failed)
@@ -1,19 +1,32 @@
 import calendar
 import logging
+import os
+import tempfile
+from datetime import datetime
+from functools import partial
+from queue import Queue
 
-import requests as r
-from tabulate import tabulate
 from telegram import ReplyKeyboardMarkup, ParseMode, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (Updater, MessageHandler, Filters,
                           ConversationHandler, CallbackQueryHandler)
 
+import export
+import metrics
 import models
+import photos
 from constants import *
-from decorators import set_utility_data, send_typing_action
-from helpers import build_menu, rates_template, bill_template, validate_new_counters_data, bill_email_template
-from mail import send_counters_email
-from scheduler import scheduler, ask_for_counters_data, mark_as_paid
-from settings import TELEGRAM_TOKEN, RENTER_USERNAME, OWNER_USERNAME
+from decorators import set_utility_data, send_typing_action, flat_required, run_async
+from helpers import build_menu, rates_template, bill_template, validate_new_counters_data, bill_email_template, \
+    get_bill_snapshot, refresh_bill_snapshot, parse_tiers
+from mail import send_counters_email, drain_outbox
+from persistence import SQLitePersistence
+from router import Router
+from scheduler import get_scheduler, ask_for_counters_data, mark_as_paid, set_bot
+from sender import reply, reply_document, send_queue
+from settings import TELEGRAM_TOKEN, UPDATER_WORKERS, OUTBOX_INTERVAL, UPDATE_QUEUE_SIZE, BOT_MODE, \
+    WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_URL_PATH, WEBHOOK_URL, WEBHOOK_CERT, WEBHOOK_KEY, PERSISTENCE_PATH, \
+    PERSISTENCE_FLUSH_INTERVAL, DB_CREATE_SCHEMA, METRICS_LISTEN, METRICS_PORT, METRICS_LOG_INTERVAL
+from tariffs import UTILITIES
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
@@ -22,24 +35,20 @@ logger = logging.getLogger(__name__)
 
 main_reply_keyboard = [['Счетчики', 'Счет'],
                        ['Шутка', 'Тарифы'],
-                       ['Оплачено', 'Пока']]
+                       ['Оплачено', 'Статистика', 'Экспорт'],
+                       ['Пока']]
 markup = ReplyKeyboardMarkup(main_reply_keyboard, one_time_keyboard=True)
+counters_markup = ReplyKeyboardMarkup([['Новые показания', 'Редактировать'], ['Меню']], one_time_keyboard=False)
+rates_markup = ReplyKeyboardMarkup([['Меню', 'Изменить тарифы']], one_time_keyboard=True)
+months_list = list(filter(None, calendar.month_name))
+months_markup = ReplyKeyboardMarkup([months_list[i:i + 3] for i in range(0, len(months_list), 3)],
+                                    one_time_keyboard=True)
 
 
 def start(update, context):
     reply_text = "Привет)"
-    update.message.reply_text(reply_text, reply_markup=markup)
-    telegram_user = update.effective_user
-    user = models.User(telegram_user, chat_id=update.effective_chat.id)
-
-    if not user.exists():
-        user.commit()
-    elif user.chat_id is not update.effective_chat.id:
-        user.chat_id = update.effective_chat.id
-        user.commit()
-
-    if telegram_user.username == OWNER_USERNAME:
-        models.FlatPayment.generate_flat_payments()
+    reply(update, reply_text, reply_markup=markup)
+    models.User.register(update.effective_user, update.effective_chat.id)
     return CHOOSING
 
 
@@ -55,21 +64,24 @@ def counters_template(counters_last):
     return f"<i>На {date.strftime('%d.%m.%Y')}:</i> \n{electricty}{gas}{water}"
 
 
-def counters(update, context):
-    """Return counters btns."""
-    counters_last = models.Counters.get_last_user_counters(update.effective_user.id)
-    msg = counters_template(counters_last)
+def render_counters(flat_id):
+    """Return cached counters message of the flat."""
+    return models.render_cache.get(
+        flat_id, 'counters', lambda: counters_template(models.Counters.get_last_flat_counters(flat_id)))
+
 
-    counters_keyboard = [['Новые показания', 'Редактировать'], ['Меню']]
-    counters_markup = ReplyKeyboardMarkup(counters_keyboard, one_time_keyboard=False)
-    update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=counters_markup)
+@models.with_session
+@flat_required
+def counters(update, context, flat):
+    """Return counters btns."""
+    reply(update, render_counters(flat.id), parse_mode=ParseMode.HTML, reply_markup=counters_markup)
 
     return CHOOSING
 
 
 def new_counters_data(update, context):
     """Set counters data."""
-    update.message.reply_text("Электричество:")
+    reply(update, "Электричество:")
     return ELECTRICITY_STATE
 
 
@@ -83,7 +95,7 @@ def edit_counters_btns(update, context):
     ]
     reply_markup = InlineKeyboardMarkup(build_menu(button_list, n_cols=2))
 
-    update.message.reply_text('Изменить последние внесенные показания для', reply_markup=reply_markup)
+    reply(update, 'Изменить последние внесенные показания для', reply_markup=reply_markup)
     return EDIT_COUNTERS_DATA
 
 
@@ -91,18 +103,19 @@ def edit_counters_data_cb(update, context):
     """Handle counters edit btn clicked."""
     query = update.callback_query
     context.user_data['edit_counters'] = query.data
-    context.bot.send_message(chat_id=update.effective_chat.id, text='Новое значение:')
+    reply(update, 'Новое значение:')
     return EDIT_COUNTERS_DATA
 
 
-def edit_counters_data(update, context):
+@models.with_session
+@flat_required
+def edit_counters_data(update, context, flat):
     """Update data."""
     counter = context.user_data['edit_counters']
-    user = update.effective_user
-    counters_last, counters_previous = models.Counters.get_last_and_previous_user_counters(user.id)
+    counters_last, counters_previous = models.Counters.get_last_and_previous_flat_counters(flat.id)
 
     if not counters_last:
-        update.message.reply_text('Нет предыдущих значений', parse_mode=ParseMode.HTML, reply_markup=markup)
+        reply(update, 'Нет предыдущих значений', parse_mode=ParseMode.HTML, reply_markup=markup)
         return CHOOSING
     try:
         new_counter_data = int(update.message.text)
@@ -110,141 +123,181 @@ def edit_counters_data(update, context):
             prev_value = getattr(counters_previous, EDIT_COUNTERS_FIELDS[counter])
             validate_new_counters_data(new_counter_data, prev_value)
     except ValueError as e:
-        update.message.reply_text('Неправильное значение. Возможно число меньше предыдущих показаний?')
+        reply(update, 'Неправильное значение. Возможно число меньше предыдущих показаний?')
         return EDIT_COUNTERS_DATA
 
     setattr(counters_last, EDIT_COUNTERS_FIELDS[counter], new_counter_data)
     counters_last.commit()
-    msg = counters_template(counters_last)
-    update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=markup)
+    refresh_bill_snapshot(flat, models.Rates.get_flat_rates(flat.id), models.BillSnapshot.COUNTERS)
+    reply(update, render_counters(flat.id), parse_mode=ParseMode.HTML, reply_markup=markup)
     del context.user_data['edit_counters']
     return CHOOSING
 
 
+@models.with_session
 @set_utility_data(ELECTRICITY)
-def set_electricity(update, context, state=None, msg=''):
+def set_electricity(update, context, state=None, msg='', flat=None):
     """Update electricity data and send response."""
     if state == CHOOSING:
-        update.message.reply_text(msg, reply_markup=markup)
-    update.message.reply_text(msg)
+        reply(update, msg, reply_markup=markup)
+    else:
+        reply(update, msg)
     return state
 
 
+@models.with_session
 @set_utility_data(GAS)
-def set_gas(update, context, state=None, msg=''):
+def set_gas(update, context, state=None, msg='', flat=None):
     """Update gas data and send response."""
     if state == CHOOSING:
-        update.message.reply_text(msg, reply_markup=markup)
-    update.message.reply_text(msg)
+        reply(update, msg, reply_markup=markup)
+    else:
+        reply(update, msg)
     return state
 
 
+@models.with_session
 @set_utility_data(WATER)
-def set_water(update, context, state=None, msg=''):
+def set_water(update, context, state=None, msg='', flat=None):
     """Update water data and send response."""
     if state == CHOOSING:
-        update.message.reply_text(msg, reply_markup=markup)
-    update.message.reply_text(msg)
+        reply(update, msg, reply_markup=markup)
+    else:
+        reply(update, msg)
     return state
 
 
+def send_counters_email_with_photo(email_template, counters):
+    """Send counters email once gas counter photo is downloaded. Thumbnail goes as attachment."""
+    email_template['gas_counter_photo'] = str(counters.gas_counter_photo_url)
+    thumb_path = counters.gas_counter_photo_thumb_path
+    send_counters_email(email_template, photos.get_store_path(thumb_path) if thumb_path else None)
+
+
+@run_async
+@models.with_session
 @set_utility_data(GAS_COUNTER_PHOTO)
-def save_gas_counter_photo(update, context, state=None, msg=''):
+def save_gas_counter_photo(update, context, state=None, msg='', flat=None):
     """Save photo."""
     user = update.effective_user
 
     if state == CHOOSING:
-        counters_last = models.Counters.get_last_user_counters(user.id)
+        counters_last = models.Counters.get_last_flat_counters(flat.id)
         msg = counters_template(counters_last)
 
-        if user.username == RENTER_USERNAME:
-            rates = models.Rates.get_default_rates()
-            email_template = bill_email_template(user.id, counters_last, rates)
-            send_counters_email(email_template)
-        update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=markup)
+        rates = models.Rates.get_flat_rates(flat.id)
+        snapshot = refresh_bill_snapshot(flat, rates, models.BillSnapshot.COUNTERS)
+
+        on_photo_stored = None
+        if flat.is_renter(user.username) and snapshot:
+            email_template = bill_email_template(counters_last, rates, snapshot)
+            on_photo_stored = partial(send_counters_email_with_photo, email_template)
+        photos.submit_counters_photo(context.bot, counters_last.id, update.message.photo, on_photo_stored)
+        reply(update, msg, parse_mode=ParseMode.HTML, reply_markup=markup)
     else:
-        update.message.reply_text(msg)
+        reply(update, msg)
     return state
 
 
+@run_async
 @send_typing_action
-def bill(update, context):
+@models.with_session
+@flat_required
+def bill(update, context, flat):
     """Return bill based on latest counters data."""
-    rates = models.Rates.get_default_rates()
-    msg = bill_template(update.effective_user.id, rates)
-    update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=markup)
+    rates = models.Rates.get_flat_rates(flat.id)
+    try:
+        snapshot = get_bill_snapshot(flat, rates)
+    except ValueError:
+        reply(update, 'Оплаченных месяцев пока нет. Отметьте оплату: <b>Оплачено > выбрать месяц</b>.',
+              parse_mode=ParseMode.HTML, reply_markup=markup)
+        return
+    reply(update, bill_template(snapshot), parse_mode=ParseMode.HTML, reply_markup=markup)
 
 
+@run_async
 def joke(update, context):
     """Get joke."""
-    response = r.get('https://sv443.net/jokeapi/category/Programming')
+    import requests as r
+
+    with metrics.timer(metrics.HTTP_REQUEST_DURATION, upstream='jokeapi'):
+        response = r.get('https://sv443.net/jokeapi/category/Programming')
     response = response.json()
     if response['type'] == 'single':
-        update.message.reply_text(response['joke'], reply_markup=markup)
+        reply(update, response['joke'], reply_markup=markup)
     else:
         setup = response.get('setup')
         delivery = response.get('delivery')
-        update.message.reply_text(f"-{setup}\n-{delivery}", reply_markup=markup)
+        reply(update, f"-{setup}\n-{delivery}", reply_markup=markup)
 
 
-def prices(update, context):
+@models.with_session
+@flat_required
+def prices(update, context, flat):
     """Return current prices for 1 water/electricity/gas."""
-    rates = models.Rates.get_default_rates()
-    msg = rates_template(rates)
+    msg = models.render_cache.get(flat.id, 'rates', lambda: rates_template(
+        models.Rates.get_flat_rates(flat.id), models.TariffTier.get_flat_tariffs(flat.id)))
 
-    if update.effective_user.username == OWNER_USERNAME:
-        reply_kb = [['Меню', 'Изменить тарифы']]
-        rates_markup = ReplyKeyboardMarkup(reply_kb, one_time_keyboard=True)
-        update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=rates_markup)
+    if flat.is_owner(update.effective_user.username):
+        reply(update, msg, parse_mode=ParseMode.HTML, reply_markup=rates_markup)
         return UPDATE_RATES
     else:
-        update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=markup)
+        reply(update, msg, parse_mode=ParseMode.HTML, reply_markup=markup)
     return CHOOSING
 
 
-def edit_rates(update, context):
+@models.with_session
+@flat_required
+def edit_rates(update, context, flat):
     """Handle rates update."""
     if ':' not in update.message.text:
-        rates = models.Rates()
-        fields = rates.__dict__
-        del fields['_sa_instance_state']
-        field_keys = [k for k in fields.keys()]
-        msg = "   ".join(field_keys)
-        update.message.reply_text(msg)
+        msg = "   ".join(models.RATES_FIELDS) + "\nТарифы по объему: electricity: 0.9 100:1.68 250:2.1"
+        reply(update, msg)
         return UPDATE_RATES
 
-    key, value = update.message.text.split(':')
+    key, value = update.message.text.split(':', 1)
 
     try:
         key = key.strip()
-        value = float(value)
-    except TypeError:
-        update.message.reply_text('Ошибка конвертации в float.')
+        if key in UTILITIES:
+            rates = models.Rates.update_flat_tariff(flat.id, key, parse_tiers(value))
+        else:
+            rates = models.Rates.update_flat_rates(flat.id, **{key: float(value)})
+    except ValueError:
+        reply(update, 'Ошибка конвертации в float.')
         return UPDATE_RATES
-    models.Rates.update_default_rates(**{key: value})
+    refresh_bill_snapshot(flat, rates, models.BillSnapshot.RATES)
     return CHOOSING
 
 
 def done(update, context):
-    update.message.reply_text("Ну, все. Пиши...)")
+    reply(update, "Ну, все. Пиши...)")
     return CHOOSING
 
 
 def main_menu(update, context):
     """Return to main menu."""
-    update.message.reply_text('>>', reply_markup=markup)
+    reply(update, '>>', reply_markup=markup)
     return CHOOSING
 
 
 def other_msgs_handler(update, context):
     """Handle messages that don't have regex handler."""
-    update.message.reply_text('Я бы поговорила, но я на работе))', reply_markup=markup)
+    reply(update, 'Я бы поговорила, но я на работе))', reply_markup=markup)
     return CHOOSING
 
 
-def generate_paid_months_template():
+def please_wait(update, context):
+    """Answer messages that come while previous run_async handler of the user is still running.
+    Conversation stays in its state, the message itself is not processed."""
+    reply(update, 'Секунду, еще обрабатываю предыдущее сообщение.')
+
+
+def generate_paid_months_template(flat_id):
     """Return beautiful table with paid months."""
-    months_paid = models.FlatPayment.get_this_year_payments()
+    from tabulate import tabulate
+
+    months_paid = models.FlatPayment.get_this_year_payments(flat_id)
     headers = ['Paid', 'Month', 'Year']
     data = []
     for m in months_paid:
@@ -254,73 +307,114 @@ def generate_paid_months_template():
     return tabulate(data or [['n', 'o', 'n', 'e']], headers=headers, tablefmt='simple', colalign=("center",))
 
 
-def get_payments_calendar(update, context):
+def render_paid_months(flat_id):
+    """Return cached paid months table of the flat. New year starts a new table."""
+    return models.render_cache.get(flat_id, ('payments', datetime.now().year),
+                                   lambda: generate_paid_months_template(flat_id))
+
+
+@run_async
+@send_typing_action
+@flat_required
+def statistics(update, context, flat):
+    """Return consumption for the last 12 months. Numpy is loaded on first use."""
+    import analytics
+    from tabulate import tabulate
+
+    report = analytics.consumption([flat.id])
+    rows = analytics.flat_report_rows(report, flat.id)
+    headers = ['Month', 'Эл.', 'Газ', 'Вода', 'грн', '± год']
+    msg = tabulate(rows or [['n', 'o', 'n', 'e']], headers=headers, tablefmt='simple')
+    reply(update, f'<pre>{msg}</pre>', parse_mode=ParseMode.HTML, reply_markup=markup)
+    return CHOOSING
+
+
+@run_async
+@send_typing_action
+@flat_required
+def export_history(update, context, flat):
+    """Send counters, bills and payments history as CSV files or XLSX workbook.
+    Typed 'Экспорт 2019-01-01 2019-12-31 xlsx' limits dates and picks format, the button sends all as CSV."""
+    try:
+        since, until, file_format = export.parse_args(update.message.text)
+    except ValueError:
+        reply(update, export.USAGE_MSG, reply_markup=markup)
+        return CHOOSING
+
+    with tempfile.TemporaryDirectory(prefix='export-') as directory:
+        for path in export.export_flat(flat.id, directory, since, until, file_format):
+            with open(path, 'rb') as f:
+                reply_document(update, f, os.path.basename(path), reply_markup=markup)
+    return CHOOSING
+
+
+@models.with_session
+@flat_required
+def get_payments_calendar(update, context, flat):
     """Returns keyboard with 12 month with list of months that were paid.."""
     username = update.effective_user.username
-    months_paid_string = generate_paid_months_template()
+    months_paid_string = render_paid_months(flat.id)
 
-    if not username == OWNER_USERNAME:
-        update.message.reply_text(months_paid_string, parse_mode=ParseMode.HTML, reply_markup=markup)
+    if not flat.is_owner(username):
+        reply(update, months_paid_string, parse_mode=ParseMode.HTML, reply_markup=markup)
         return CHOOSING
 
-    months_list = list(filter(None, calendar.month_name))
-    months_keyboard = [months_list[i:i + 3] for i in range(0, len(list(months_list)), 3)]
-    counters_markup = ReplyKeyboardMarkup(months_keyboard, one_time_keyboard=True)
-    update.message.reply_text(months_paid_string, parse_mode=ParseMode.HTML, reply_markup=counters_markup)
+    reply(update, months_paid_string, parse_mode=ParseMode.HTML, reply_markup=months_markup)
 
     return CALENDAR_STATE
 
 
-def set_unset_month_paid(update, context):
+@models.with_session
+@flat_required
+def set_unset_month_paid(update, context, flat):
     """Check is_paid for selected month."""
-    if not update.effective_user.username == OWNER_USERNAME:
-        update.message.reply_text('Упс, так нельзя.', reply_markup=markup)
+    if not flat.is_owner(update.effective_user.username):
+        reply(update, 'Упс, так нельзя.', reply_markup=markup)
         return CHOOSING
 
     month_name = update.message.text
     if month_name in list(calendar.month_name):
         month_number = list(calendar.month_name).index(month_name)
-        models.FlatPayment.mark_as_paid_or_unpaid(month_number)
-        months_paid_string = generate_paid_months_template()
-        update.message.reply_text(months_paid_string, reply_markup=markup)
+        models.FlatPayment.mark_as_paid_or_unpaid(month_number, flat.id)
+        refresh_bill_snapshot(flat, models.Rates.get_flat_rates(flat.id), models.BillSnapshot.PAYMENT)
+        reply(update, render_paid_months(flat.id), reply_markup=markup)
     else:
-        update.message.reply_text('менюшечка', reply_markup=markup)
+        reply(update, 'менюшечка', reply_markup=markup)
     return CHOOSING
 
 
 def error(update, context):
     """Log Errors caused by Updates."""
-    logger.warning('Update "%s" caused error "%s"', update, error)
-
-
-def conversation_handler():
-    """Decides how to answer on user messages."""
-    default_regex_commands = 'Счетчики|Тарифы|Счет|Шутка|Новые показания|Меню|Пока|payments'
-    return ConversationHandler(
+    logger.warning('Update "%s" caused error "%s"', update, context.error)
+
+
+def choosing_routes():
+    """Main menu buttons. Order matters only for texts that are not exactly a button."""
+    return {
+        'Счетчики': counters,
+        'Тарифы': prices,
+        'Счет': bill,
+        'Шутка': joke,
+        'Новые показания': new_counters_data,
+        'Редактировать': edit_counters_btns,
+        'Меню': main_menu,
+        'Оплачено': get_payments_calendar,
+        'Статистика': statistics,
+        'Экспорт': export_history,
+        'Пока': done,
+    }
+
+
+def conversation_handler(persistent=False):
+    """Decides how to answer on user messages. Persistent handler keeps conversations over restarts.
+    Every callback is timed, see metrics."""
+    return metrics.instrument_conversation(ConversationHandler(
         entry_points=[
-            MessageHandler(Filters.regex('.'), start)
+            MessageHandler(Filters.text, start)
         ],
 
         states={
-            CHOOSING: [MessageHandler(Filters.regex('Счетчики'),
-                                      counters),
-                       MessageHandler(Filters.regex('Тарифы'),
-                                      prices),
-                       MessageHandler(Filters.regex('Счет'),
-                                      bill),
-                       MessageHandler(Filters.regex('Шутка'),
-                                      joke),
-                       MessageHandler(Filters.regex('Новые показания'),
-                                      new_counters_data),
-                       MessageHandler(Filters.regex('Редактировать'),
-                                      edit_counters_btns),
-                       MessageHandler(Filters.regex('Меню'),
-                                      main_menu),
-                       MessageHandler(Filters.regex('Оплачено'),
-                                      get_payments_calendar),
-                       MessageHandler(Filters.regex(f'^(?!.*({default_regex_commands}))'),
-                                      other_msgs_handler),
-                       ],
+            CHOOSING: [Router(choosing_routes(), default=other_msgs_handler)],
 
             ELECTRICITY_STATE: [MessageHandler(Filters.text, set_electricity)],
             GAS_STATE: [MessageHandler(Filters.text, set_gas)],
@@ -340,34 +434,82 @@ def conversation_handler():
                 MessageHandler(Filters.text,
                                edit_rates),
             ],
+            ConversationHandler.WAITING: [MessageHandler(Filters.all, please_wait)],
         },
 
         fallbacks=[MessageHandler(Filters.regex('Пока'), done)],
         name="my_conversation",
-        persistent=False
-    )
+        persistent=persistent
+    ))
+
+
+def create_updater():
+    """Create updater with UPDATER_WORKERS workers for run_async handlers and update queue bounded by UPDATE_QUEUE_SIZE.
+    Conversations and user_data are kept in PERSISTENCE_PATH unless it is empty."""
+    persistence = SQLitePersistence(PERSISTENCE_PATH, PERSISTENCE_FLUSH_INTERVAL) if PERSISTENCE_PATH else None
+    updater = Updater(TELEGRAM_TOKEN, workers=UPDATER_WORKERS, use_context=True, persistence=persistence)
+
+    if UPDATE_QUEUE_SIZE:
+        # Webhook requests wait for a free slot (and Telegram retries them) instead of piling up in memory.
+        updater.update_queue = updater.dispatcher.update_queue = Queue(maxsize=UPDATE_QUEUE_SIZE)
+    return updater
+
+
+def start_updater(updater):
+    """Start receiving updates by long polling or by webhook, depending on BOT_MODE."""
+    if BOT_MODE != 'webhook':
+        updater.start_polling()
+        return
+
+    # Without cert/key the listener is plain HTTP, TLS is terminated by the reverse proxy in front of it.
+    webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_URL_PATH}" if WEBHOOK_URL else None
+    updater.start_webhook(listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_URL_PATH,
+                          cert=WEBHOOK_CERT, key=WEBHOOK_KEY, webhook_url=webhook_url)
+    logger.info('Listening for webhook updates on %s:%s', WEBHOOK_LISTEN, WEBHOOK_PORT)
 
 
 def main():
-    updater = Updater(TELEGRAM_TOKEN, use_context=True)
+    if DB_CREATE_SCHEMA:
+        models.create_schema()
+    metrics.instrument_engine(models.engine)
+    if METRICS_PORT:
+        metrics.start_server(METRICS_LISTEN, METRICS_PORT)
+    models.with_session(models.Flat.get_or_create_default)()
+    models.with_session(models.user_registry.warm)()
+    updater = create_updater()
 
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
 
     # Add conversation handler with the states CHOOSING, TYPING_CHOICE and TYPING_REPLY
-    conv_handler = conversation_handler()
+    conv_handler = conversation_handler(persistent=updater.persistence is not None)
 
     dp.add_handler(conv_handler)
     dp.add_error_handler(error)
-    updater.start_polling()
-    updater.idle()
 
-    scheduler.add_job(ask_for_counters_data, 'cron', day=1, hour=7)
-    scheduler.add_job(ask_for_counters_data, 'cron', day=3, hour=17)
-    scheduler.add_job(ask_for_counters_data, 'cron', day=5, hour=7)
-    scheduler.add_job(mark_as_paid, 'cron', day=15, hour=7)
+    # Jobs are stored in DB, so they are replaced by id instead of being added again on every start.
+    set_bot(updater.bot)
+    scheduler = get_scheduler()
+    scheduler.add_job(ask_for_counters_data, 'cron', day=1, hour=7,
+                      id='ask_for_counters_data_1', replace_existing=True)
+    scheduler.add_job(ask_for_counters_data, 'cron', day=3, hour=17,
+                      id='ask_for_counters_data_3', replace_existing=True)
+    scheduler.add_job(ask_for_counters_data, 'cron', day=5, hour=7,
+                      id='ask_for_counters_data_5', replace_existing=True)
+    scheduler.add_job(mark_as_paid, 'cron', day=15, hour=7, id='mark_as_paid', replace_existing=True)
+    scheduler.add_job(drain_outbox, 'interval', seconds=OUTBOX_INTERVAL, id='drain_outbox', replace_existing=True,
+                      coalesce=True, max_instances=1)
+    if METRICS_LOG_INTERVAL:
+        scheduler.add_job(metrics.log_summary, 'interval', seconds=METRICS_LOG_INTERVAL, id='log_metrics_summary',
+                          replace_existing=True, coalesce=True, max_instances=1)
+    scheduler.start()
+
+    start_updater(updater)
+    updater.idle()
+    send_queue.stop(timeout=10)
+    if updater.persistence:
+        updater.persistence.stop()
 
 
 if __name__ == '__main__':
-    scheduler.start()
     main()
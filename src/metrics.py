@@ -0,0 +1,234 @@
+"""Timing of handlers, DB queries and upstream HTTP calls.
+
+Observations go to in-process histograms with fixed buckets, so recording one is a bisect and a few additions.
+They are exposed in Prometheus text format on METRICS_LISTEN:METRICS_PORT/metrics and logged by log_summary.
+"""
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+HANDLER_DURATION = 'bot_handler_duration_seconds'
+HANDLER_ERRORS = 'bot_handler_errors_total'
+DB_QUERY_DURATION = 'bot_db_query_duration_seconds'
+HTTP_REQUEST_DURATION = 'bot_http_request_duration_seconds'
+MESSAGES_COALESCED = 'bot_messages_coalesced_total'
+MESSAGES_FAILED = 'bot_messages_failed_total'
+CACHE_EVENTS = 'bot_cache_events_total'
+REMINDERS = 'bot_reminders_total'
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+    def copy(self):
+        histogram = Histogram(len(self.counts))
+        histogram.counts, histogram.sum, histogram.count = list(self.counts), self.sum, self.count
+        return histogram
+
+
+class Registry:
+    """Histograms and counters by metric name and labels."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._counters = {}
+        self._last_summary = {}
+        self._last_counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(len(self.buckets) + 1)
+            histogram.counts[index] += 1
+            histogram.sum += seconds
+            histogram.count += 1
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def snapshot(self):
+        """Returns copies of histograms and counters."""
+        with self._lock:
+            return ({key: histogram.copy() for key, histogram in self._histograms.items()}, dict(self._counters))
+
+    def render(self):
+        """Returns all metrics in Prometheus text format."""
+        histograms, counters = self.snapshot()
+        lines = []
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f'# TYPE {name} histogram')
+            for (series_name, labels), histogram in sorted(histograms.items()):
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels, le=bound)} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f'# TYPE {name} counter')
+            for (series_name, labels), value in sorted(counters.items()):
+                if series_name == name:
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Returns (name, labels, count, avg seconds, p95 upper bound seconds) observed since the previous call."""
+        histograms, _ = self.snapshot()
+        rows = []
+        for key, histogram in sorted(histograms.items()):
+            previous = self._last_summary.get(key)
+            count = histogram.count - (previous.count if previous else 0)
+            if not count:
+                continue
+            counts = [c - (previous.counts[i] if previous else 0) for i, c in enumerate(histogram.counts)]
+            total = histogram.sum - (previous.sum if previous else 0)
+            rows.append((*key, count, total / count, self.percentile_bound(counts, count, 0.95)))
+        self._last_summary = histograms
+        return rows
+
+    def counter_summary(self):
+        """Returns (name, labels, increase) of counters that grew since the previous call."""
+        _, counters = self.snapshot()
+        rows = [(*key, value - self._last_counters.get(key, 0)) for key, value in sorted(counters.items())
+                if value != self._last_counters.get(key, 0)]
+        self._last_counters = counters
+        return rows
+
+    def percentile_bound(self, counts, total, percentile):
+        """Upper bound of the bucket where the percentile falls."""
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            if cumulative >= percentile * total:
+                return bound
+        return float('inf')
+
+
+def format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+registry = Registry()
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observe duration of the with block."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(name, time.perf_counter() - started, **labels)
+
+
+def timed_handler(callback):
+    """Observe duration of the conversation handler callback and count its errors.
+    Callbacks that run in the worker pool (decorators.run_async) are timed in the worker."""
+    if getattr(callback, 'run_async', None):
+        return callback.run_async(timed_handler(callback.__wrapped__))
+    handler = callback.__name__
+
+    @wraps(callback)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return callback(*args, **kwargs)
+        except Exception:
+            registry.inc(HANDLER_ERRORS, handler=handler)
+            raise
+        finally:
+            registry.observe(HANDLER_DURATION, time.perf_counter() - started, handler=handler)
+
+    return wrapper
+
+
+def instrument_conversation(conversation):
+    """Time every callback of the ConversationHandler."""
+    handlers = list(conversation.entry_points) + list(conversation.fallbacks)
+    for state_handlers in conversation.states.values():
+        handlers.extend(state_handlers)
+
+    for handler in handlers:
+        if hasattr(handler, 'map_callbacks'):
+            handler.map_callbacks(timed_handler)
+        else:
+            handler.callback = timed_handler(handler.callback)
+    return conversation
+
+
+def instrument_engine(engine):
+    """Time every query of the engine by statement type."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        registry.observe(DB_QUERY_DURATION, elapsed, operation=statement.split(None, 1)[0].upper())
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        started = exception_context.connection.info.get('query_started') if exception_context.connection else None
+        if started:
+            started.pop()
+
+
+def start_server(listen, port):
+    """Serve metrics on http://listen:port/metrics in a daemon thread."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((listen, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Serving metrics on %s:%s/metrics', listen, port)
+    return server
+
+
+def log_summary():
+    """Log count, average and p95 of everything observed and increase of counters since the previous summary."""
+    for name, labels, count, avg, p95 in registry.summary():
+        logger.info('%s%s: %s calls, avg %.1f ms, p95 <= %.1f ms', name, format_labels(labels), count, avg * 1000,
+                    p95 * 1000)
+    for name, labels, increase in registry.counter_summary():
+        logger.info('%s%s: +%s', name, format_labels(labels), increase)
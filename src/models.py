@@ -1,33 +1,176 @@
-from datetime import datetime
+import json
+from collections import namedtuple
+from datetime import datetime, timedelta, date
+from functools import wraps
 
 from sqlalchemy import Column, Integer, String, Boolean, exists, DateTime, func, desc, create_engine, ForeignKey, Float, \
-    UniqueConstraint
+    UniqueConstraint, Index, or_, and_, Text, bindparam, Date, select, literal
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import relationship, sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from cache import TTLCache, Registry, RenderCache
+from tariffs import Tariff, TariffIndex, EPOCH
+from settings import DB_URL, RENTER_USERNAME, OWNER_USERNAME, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE, \
+    DB_POOL_TIMEOUT, RATES_CACHE_TTL, FLAT_CACHE_TTL, RENDER_CACHE_TTL
+
+
+def get_engine_options(db_url):
+    """Return create_engine kwargs. In-memory sqlite uses one connection for all threads, so they see the same db."""
+    url = make_url(db_url)
+    options = {}
+
+    if url.get_backend_name() == 'sqlite':
+        options['connect_args'] = {'check_same_thread': False}
+        if not url.database or url.database == ':memory:':
+            options['poolclass'] = StaticPool
+            return options
+        options['poolclass'] = QueuePool
+    options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_recycle=DB_POOL_RECYCLE,
+                   pool_timeout=DB_POOL_TIMEOUT, pool_pre_ping=True)
+    return options
+
 
 # Create an engine which the Session will use for connections.
-from helpers import get_heating_bill
-from settings import DB_URL, RENTER_USERNAME
+engine = create_engine(DB_URL, **get_engine_options(DB_URL))
+
+# Thread-local sessions. Every update handler and scheduler job gets its own session via with_session.
+Session = scoped_session(sessionmaker(bind=engine))
+session = Session
 
-engine = create_engine(DB_URL, connect_args={'check_same_thread': False})
 
-# Create session
-Session = sessionmaker(bind=engine)
-session = Session()
+def with_session(func):
+    """Run func in its own thread-local session and close it afterwards.
+    Nested calls reuse the session of the outermost one."""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        is_owner = not Session.registry.has()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if is_owner:
+                Session.remove()
+
+    return wrapper
+
+
+def bulk_upsert(model, rows, get_key, existing):
+    """Insert rows of flats that are not in existing {key: id} and update the rest, in one transaction.
+    Later duplicates in rows win. Returns numbers of inserted and updated rows.
+    Mappings go to executemany of Core statements, ORM bulk_*_mappings spend most of the time per row in Python."""
+    table = model.__table__
+    flat_ids = {row['flat_id'] for row in rows}
+    rows = {get_key(row): row for row in rows}
+    inserts = [row for key, row in rows.items() if key not in existing]
+    updates = [{**row, 'row_id': existing[key]} for key, row in rows.items() if key in existing]
+
+    if inserts:
+        session.execute(table.insert(), inserts)
+    if updates:
+        session.execute(table.update().where(table.c.id == bindparam('row_id')), updates)
+    session.commit()
+    for flat_id in flat_ids:
+        render_cache.bump(flat_id)
+    return len(inserts), len(updates)
+
 
 # Create a base for the models to build upon.
 Base = declarative_base()
 
 
+class FlatInfo(namedtuple('FlatInfo', ('id', 'name', 'owner_username', 'renter_username', 'heating_account'))):
+    """Immutable copy of the flat row. Safe to keep in cache and share between threads."""
+
+    __slots__ = ()
+
+    def is_owner(self, username):
+        return bool(username) and username == self.owner_username
+
+    def is_renter(self, username):
+        return bool(username) and username == self.renter_username
+
+
+class UserInfo(namedtuple('UserInfo', ('user_id', 'chat_id', 'first_name', 'last_name', 'username', 'flat_id',
+                                         'is_renter', 'is_muted'))):
+    """Immutable copy of the user row. Kept in user_registry."""
+
+    __slots__ = ()
+
+
+class Flat(Base):
+    """Flat owns its renters, rates, payments and counters.
+    Users are attached to the flat by owner/renter username when they write to the bot for the first time."""
+
+    __tablename__ = "flats"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    owner_username = Column(String, index=True)
+    renter_username = Column(String, index=True)
+    heating_account = Column(String)
+    renters = relationship("User", backref='flat')
+
+    def __repr__(self):
+        return f"Flat {self.name} ({self.id})"
+
+    @staticmethod
+    def get_or_create_default():
+        """Returns first flat. Creates it from OWNER/RENTER settings if there are no flats yet."""
+        flat = session.query(Flat).order_by(Flat.id).first()
+
+        if not flat:
+            flat = Flat(name='default', owner_username=OWNER_USERNAME, renter_username=RENTER_USERNAME)
+            flat.commit()
+        return flat
+
+    @staticmethod
+    def find_by_username(username):
+        """Returns flat where username is renter or owner. Renter match goes first."""
+        if not username:
+            return None
+        return session.query(Flat).filter(or_(Flat.renter_username == username, Flat.owner_username == username)). \
+            order_by((Flat.renter_username == username).desc(), Flat.id).first()
+
+    @staticmethod
+    def get_by_chat_id(chat_id):
+        """Returns cached FlatInfo for the chat or None if chat user has no flat."""
+        return flat_cache.get(chat_id)
+
+    @staticmethod
+    @with_session
+    def load_by_chat_id(chat_id):
+        """Returns FlatInfo for the chat or None."""
+        flat = session.query(Flat).join(User, User.flat_id == Flat.id).filter(User.chat_id == chat_id).first()
+        return flat.snapshot() if flat else None
+
+    @staticmethod
+    def get_flat_ids():
+        return [flat_id for flat_id, in session.query(Flat.id).order_by(Flat.id)]
+
+    def snapshot(self):
+        """Returns immutable copy of the flat."""
+        return FlatInfo(self.id, self.name, self.owner_username, self.renter_username, self.heating_account)
+
+    def commit(self):
+        session.add(self)
+        session.commit()
+        flat_cache.invalidate()
+
+
 class User(Base):
     """User will be created when /start command used."""
     __tablename__ = "users"
 
+    PROFILE_FIELDS = ('chat_id', 'first_name', 'last_name', 'username')
+
     user_id = Column(Integer, primary_key=True)
-    chat_id = Column(Integer)
+    chat_id = Column(Integer, index=True)
     first_name = Column(String, nullable=False)
     last_name = Column(String)
     username = Column(String)
+    flat_id = Column(Integer, ForeignKey('flats.id'), index=True)
     counters = relationship("Counters", backref='users')
     is_renter = Column(Boolean, default=False)
     is_muted = Column(Boolean, default=False)
@@ -48,12 +191,76 @@ class User(Base):
     def get_user_by_username(username):
         return session.query(User).filter(User.username == username).first()
 
+    @staticmethod
+    def get_renters_without_counters(since):
+        """Returns (user_id, chat_id) of every renter whose flat has no counters data since the date."""
+        has_counters = exists().where(Counters.flat_id == User.flat_id).where(Counters.created >= since)
+        return session.query(User.user_id, User.chat_id).filter(
+            User.is_renter.is_(True), User.chat_id.isnot(None), User.is_muted.isnot(True), ~has_counters).all()
+
+    def assign_flat(self):
+        """Attach user to the flat where the username is renter or owner. User has one flat, see find_by_username."""
+        flat = Flat.find_by_username(self.username)
+
+        if flat:
+            self.flat_id = flat.id
+            self.is_renter = flat.renter_username == self.username
+
+    @staticmethod
+    def register(telegram_user, chat_id):
+        """Save user who wrote to the bot and returns UserInfo.
+        Users already in user_registry with the same profile and a flat cost no DB queries. Users without a flat
+        are looked up again, their flat could be added after they wrote first."""
+        profile = {'chat_id': chat_id, 'first_name': telegram_user.first_name, 'last_name': telegram_user.last_name,
+                   'username': telegram_user.username}
+        user_info = user_registry.get(telegram_user.id)
+
+        if user_info and user_info.flat_id is not None and \
+                all(getattr(user_info, field) == value for field, value in profile.items()):
+            return user_info
+        return User.save_profile(telegram_user, profile)
+
+    @staticmethod
+    @with_session
+    def save_profile(telegram_user, profile):
+        """Create user or write profile fields that differ from the saved ones. Attach user without a flat to one."""
+        user = session.query(User).get(telegram_user.id)
+        old_chat_id = user.chat_id if user else None
+
+        if not user:
+            user = User(telegram_user, chat_id=profile['chat_id'])
+            session.add(user)
+        else:
+            for field, value in profile.items():
+                if getattr(user, field) != value:
+                    setattr(user, field, value)
+        if user.flat_id is None:
+            user.assign_flat()
+
+        if session.new or session.dirty:
+            session.commit()
+            flat_cache.invalidate(old_chat_id)
+            flat_cache.invalidate(user.chat_id)
+        user_info = user.snapshot()
+        user_registry.set(user_info)
+        return user_info
+
+    @staticmethod
+    def load_all():
+        return [user.snapshot() for user in session.query(User)]
+
+    def snapshot(self):
+        """Returns immutable copy of the user."""
+        return UserInfo(self.user_id, self.chat_id, self.first_name, self.last_name, self.username, self.flat_id,
+                        self.is_renter, self.is_muted)
+
     def commit(self):
-        if self.username == RENTER_USERNAME:
-            Counters.load_previous_counters_data(self)
-            self.is_renter = True
-        session.add(self)
+        if self.flat_id is None:
+            self.assign_flat()
+        user = session.merge(self)
         session.commit()
+        flat_cache.invalidate(self.chat_id)
+        user_registry.set(user.snapshot())
 
     def __repr__(self):
         return "<User (user_id='%i', first_name='%s', username='%s')>" % (
@@ -61,8 +268,99 @@ class User(Base):
         )
 
 
-class Rates(Base):
-    """Services rates."""
+RATES_FIELDS = ('water', 'gas', 'electricity_before_100', 'electricity_after_100', 'garbage_removal', 'sdpt', 'flat',
+                'flat_summer')
+# Electricity up to this many kWh per bill is charged by electricity_before_100 rate, the rest by electricity_after_100.
+ELECTRICITY_FIRST_TIER = 100
+SUMMER_MONTHS = (6, 7, 8)
+# Rates fields that are prices of the tariff tiers: field: (utility, tier).
+TARIFF_RATES = {'electricity_before_100': ('electricity', 0), 'electricity_after_100': ('electricity', 1),
+                'gas': ('gas', 0), 'water': ('water', 0)}
+
+
+class RatesMixin:
+    """Bill calculations based on rates. Shared by Rates and RatesSnapshot."""
+
+    __slots__ = ()
+
+    def get_flat_price(self, on=None):
+        """Returns flat price depending on season."""
+        on = on or datetime.now()
+        return self.flat_summer if on.month in SUMMER_MONTHS else self.flat
+
+    def get_tiers(self):
+        """Returns {utility: [(start, price), ...]} of these rates."""
+        return {
+            'electricity': [(0, self.electricity_before_100), (ELECTRICITY_FIRST_TIER, self.electricity_after_100)],
+            'gas': [(0, self.gas)],
+            'water': [(0, self.water)],
+        }
+
+    def get_tariffs(self):
+        """Returns {utility: Tariff} built from these rates. Used where the flat has no tariff versions yet."""
+        return {utility: Tariff.from_tiers(tiers) for utility, tiers in self.get_tiers().items()}
+
+    @staticmethod
+    def diff_month(d1, d2):
+        return (d1.year - d2.year) * 12 + d1.month - d2.month
+
+    @staticmethod
+    def calculate_flat_bill(flat_price, exchange_rate, last_payment_date):
+        """Check when last payment was done. Get diff, then multiply diff * flat price * exchange rate."""
+        months_after_last_payment = RatesMixin.diff_month(datetime.now(), last_payment_date) or 1
+        flat = flat_price * exchange_rate * abs(months_after_last_payment)
+        return flat
+
+    @staticmethod
+    def calculate_sdpt_garbage_removal(last_counters_date, sdpt_rate, garbage_removal_rate):
+        """Check date of the last counters data. Get diff, then multiply diff * rates.
+        By default we assume that 1 month passed."""
+        months_after_last_payment = 1
+        if last_counters_date:
+            months_after_last_payment = RatesMixin.diff_month(datetime.now(), last_counters_date) or 1
+        sdpt = months_after_last_payment * sdpt_rate
+        garbage_removal = months_after_last_payment * garbage_removal_rate
+        return sdpt, garbage_removal
+
+    def calculate_total_price(self, flat_price, exchange_rate, counters_difference, last_payment_date, heating=None,
+                              tariffs=None, costs=None):
+        """Calculate total price for the flat with bills for the water/gas/energy...
+        Consumption is charged by tariffs ({utility: Tariff}), utilities missing there by these rates.
+        costs ({utility: cost}) are consumption costs calculated already, e.g. by TariffIndex.cost_many.
+        Bills that could not be calculated yet (no exchange rate or heating bill) are None and listed in 'pending'."""
+        electricity_difference, gas_difference, water_difference, last_counters_created_date = counters_difference
+        if costs is None:
+            tariffs = {**self.get_tariffs(), **(tariffs or {})}
+            costs = {'electricity': tariffs['electricity'].cost(electricity_difference),
+                     'gas': tariffs['gas'].cost(gas_difference),
+                     'water': tariffs['water'].cost(water_difference)}
+        bills = dict()
+        bills['electricity'] = costs['electricity']
+        bills['flat'] = None
+        if exchange_rate:
+            bills['flat'] = self.calculate_flat_bill(flat_price, exchange_rate, last_payment_date)
+
+        bills['gas'] = costs['gas']
+        bills['water'] = costs['water']
+        bills['sdpt'], bills['garbage_removal'] = self.calculate_sdpt_garbage_removal(last_counters_created_date,
+                                                                                      self.sdpt, self.garbage_removal)
+        bills['heating'] = heating
+        bills['pending'] = [k for k in ('flat', 'heating') if bills[k] is None]
+        bills['total'] = sum(bills[k] or 0 for k in ('flat', 'electricity', 'gas', 'water', 'sdpt',
+                                                     'garbage_removal', 'heating'))
+        bills['last_counters_created_date'] = last_counters_created_date
+
+        return bills
+
+
+class RatesSnapshot(RatesMixin, namedtuple('RatesSnapshot', ('id', 'version') + RATES_FIELDS)):
+    """Immutable copy of the rates row. Safe to keep in cache and share between threads."""
+
+    __slots__ = ()
+
+
+class Rates(RatesMixin, Base):
+    """Services rates. Every update bumps version, so cached snapshots can tell they are outdated."""
 
     __tablename__ = "rates"
 
@@ -75,9 +373,13 @@ class Rates(Base):
     sdpt = Column(Float)
     flat = Column(Float)
     flat_summer = Column(Float)
+    flat_id = Column(Integer, ForeignKey('flats.id'))
+    version = Column(Integer, nullable=False, server_default='1')
+    __table_args__ = (UniqueConstraint('flat_id', name='_rates_flat_uc'),)
+    __mapper_args__ = {'version_id_col': version}
 
     def __init__(self, water=23.6, gas=7.5, electricity_before_100=0.9, electricity_after_100=1.68,
-                 garbage_removal=17.11, sdpt=148.73, flat=200, flat_summer=300):
+                 garbage_removal=17.11, sdpt=148.73, flat=200, flat_summer=300, flat_id=None):
         self.water = water
         self.gas = gas
         self.electricity_before_100 = electricity_before_100
@@ -86,105 +388,160 @@ class Rates(Base):
         self.sdpt = sdpt
         self.flat = flat
         self.flat_summer = flat_summer
+        self.flat_id = flat_id
 
     @staticmethod
-    def create_default_rates():
-        """Creates instance with default rates."""
-        default_rates = Rates()
+    def create_default_rates(flat_id):
+        """Creates instance with default rates for the flat."""
+        default_rates = Rates(flat_id=flat_id)
         default_rates.commit()
         return default_rates
 
     @staticmethod
-    def update_default_rates(**data):
-        """Update default rates."""
-        default_rates = Rates.get_default_rates()
+    def update_flat_rates(flat_id, **data):
+        """Update flat rates. Changed consumption prices become a new tariff version from the current month,
+        so bills of the earlier months keep the old prices."""
+        flat_rates = Rates.get_flat_rates_instance(flat_id)
+        old_tariffs = flat_rates.get_tariffs()
+        tier_prices = {}
         for k, v in data.items():
-            if k in default_rates.__dict__:
-                setattr(default_rates, k, v)
-        default_rates.commit()
-        return default_rates
+            if k in RATES_FIELDS:
+                setattr(flat_rates, k, v)
+            if k in TARIFF_RATES:
+                utility, tier = TARIFF_RATES[k]
+                tier_prices.setdefault(utility, {})[tier] = v
+        flat_rates.commit()
+
+        effective_from = date.today().replace(day=1)
+        for utility, prices in tier_prices.items():
+            tiers = TariffTier.get_current_tiers(flat_id, utility, effective_from, old_tariffs[utility])
+            for tier, price in prices.items():
+                if tier < len(tiers):
+                    tiers[tier] = (tiers[tier][0], price)
+                else:
+                    tiers.append((ELECTRICITY_FIRST_TIER, price))
+            TariffTier.save_version(flat_id, utility, tiers, effective_from)
+        return flat_rates
 
     @staticmethod
-    def get_default_rates():
-        """Returns instance with default rates."""
-        default_rates = session.query(Rates).get(1)
+    def update_flat_tariff(flat_id, utility, tiers):
+        """Save [(start, price), ...] tiers as the utility tariff version from the current month.
+        Rates fields of the tier prices follow them."""
+        tiers = Tariff.from_tiers(tiers).tiers
+        fields = {field: tiers[tier][1] for field, (field_utility, tier) in TARIFF_RATES.items()
+                  if field_utility == utility and tier < len(tiers)}
+        flat_rates = Rates.update_flat_rates(flat_id, **fields)
+        TariffTier.save_version(flat_id, utility, tiers, date.today().replace(day=1))
+        return flat_rates
 
-        if not default_rates:
-            default_rates = Rates.create_default_rates()
-        return default_rates
+    @staticmethod
+    def get_flat_rates_instance(flat_id):
+        """Returns db instance with flat rates. Creates default rates if flat has none."""
+        flat_rates = session.query(Rates).filter_by(flat_id=flat_id).first()
 
-    def get_flat_price(self):
-        """Returns flat price depending on season."""
-        now = datetime.now()
-        current_month = now.strftime('%m')
-        summer_months = ['06', '07', '08']
+        if not flat_rates:
+            flat_rates = Rates.create_default_rates(flat_id)
+        return flat_rates
 
-        if current_month in summer_months:
-            price = self.flat_summer
-        else:
-            price = self.flat
-        return price
+    @staticmethod
+    def load_all_flat_rates(flat_ids=None):
+        """Returns {flat_id: snapshot of flat rates} of the flats, all by default, with one query.
+        Flats without rates get default ones."""
+        query = session.query(Rates.flat_id, Rates.id, Rates.version, *(getattr(Rates, field) for field in RATES_FIELDS)). \
+            filter(Rates.flat_id.isnot(None))
+        if flat_ids is not None:
+            query = query.filter(Rates.flat_id.in_(flat_ids))
+        rates = {flat_id: RatesSnapshot(*row) for flat_id, *row in query}
+        flat_ids = Flat.get_flat_ids() if flat_ids is None else flat_ids
+        missing = [Rates(flat_id=flat_id) for flat_id in set(flat_ids) - set(rates)]
+        if missing:
+            session.add_all(missing)
+            session.commit()
+            rates.update((flat_rates.flat_id, flat_rates.snapshot()) for flat_rates in missing)
+        return rates
 
     @staticmethod
-    def diff_month(d1, d2):
-        return (d1.year - d2.year) * 12 + d1.month - d2.month
+    def get_flat_rates(flat_id):
+        """Returns cached snapshot of flat rates."""
+        return rates_cache.get(flat_id)
 
     @staticmethod
-    def calculate_electricity(electricity, electricity_before_100_rate, electricity_after_100_rate):
-        """0-100 electricity has different price than 100+."""
-        electricity_before_100 = electricity
-        electricity_after_100 = 0
+    @with_session
+    def load_flat_rates(flat_id):
+        """Returns snapshot of flat rates. Cached snapshot is reused while rates version is the same."""
+        cached_rates = rates_cache.peek(flat_id)
+        version = session.query(Rates.version).filter(Rates.flat_id == flat_id).scalar()
 
-        if electricity >= 100:
-            electricity_before_100 = 100
-            electricity_after_100 = electricity - 100
-        electricity = electricity_before_100 * electricity_before_100_rate + electricity_after_100 * \
-                      electricity_after_100_rate
-        return electricity
+        if cached_rates and cached_rates.version == version:
+            return cached_rates
+        return Rates.get_flat_rates_instance(flat_id).snapshot()
+
+    def snapshot(self):
+        """Returns immutable copy of the rates."""
+        return RatesSnapshot(self.id, self.version, *(getattr(self, field) for field in RATES_FIELDS))
+
+    def commit(self):
+        session.add(self)
+        session.commit()
+        rates_cache.invalidate(self.flat_id)
+        render_cache.bump(self.flat_id)
 
-    @staticmethod
-    def calculate_flat_bill(flat_price, exchange_rate):
-        """Check when last payment was done. Get diff, then multiply diff * flat price * exchange rate."""
-        last_payment_date = FlatPayment.get_last_payment_date()
-        months_after_last_payment = Rates.diff_month(datetime.now(), last_payment_date) or 1
-        flat = flat_price * exchange_rate * abs(months_after_last_payment)
-        return flat
+
+class TariffTier(Base):
+    """One tier of a tariff version. Version is every tier of the flat utility with the same effective_from,
+    it is in effect from that date until the next version."""
+
+    __tablename__ = "tariff_tiers"
+
+    id = Column(Integer, primary_key=True)
+    flat_id = Column(Integer, ForeignKey('flats.id'), nullable=False)
+    utility = Column(String, nullable=False)
+    effective_from = Column(Date, nullable=False)
+    start = Column(Float, nullable=False)
+    price = Column(Float, nullable=False)
+    __table_args__ = (UniqueConstraint('flat_id', 'utility', 'effective_from', 'start', name='_tariff_tier_uc'),)
+
+    def __repr__(self):
+        return f"Tariff {self.utility} from {self.effective_from}: {self.price} above {self.start}"
 
     @staticmethod
-    def calculate_sdpt_garbage_removal(last_counters_date, sdpt_rate, garbage_removal_rate):
-        """Check date of the last counters data. Get diff, then multiply diff * rates.
-        By default we assume that 1 month passed."""
-        months_after_last_payment = 1
-        if last_counters_date:
-            months_after_last_payment = Rates.diff_month(datetime.now(), last_counters_date) or 1
-        sdpt = months_after_last_payment * sdpt_rate
-        garbage_removal = months_after_last_payment * garbage_removal_rate
-        return sdpt, garbage_removal
+    @with_session
+    def load_index():
+        """Returns TariffIndex of all flats."""
+        return TariffIndex.from_rows(session.query(TariffTier.flat_id, TariffTier.utility, TariffTier.effective_from,
+                                                   TariffTier.start, TariffTier.price))
 
-    def calculate_total_price(self, flat_price, exchange_rate, user_id):
-        """Calculate total price for the flat with bills for the water/gas/energy..."""
-        electricity_difference, gas_difference, water_difference, last_counters_created_date = \
-            Counters.get_last_values_difference(user_id)
-        bills = dict()
-        bills['electricity'] = self.calculate_electricity(electricity_difference,
-                                                          self.electricity_before_100,
-                                                          self.electricity_after_100)
-        bills['flat'] = self.calculate_flat_bill(flat_price, exchange_rate)
+    @staticmethod
+    def get_index():
+        """Returns cached TariffIndex of all flats."""
+        return tariff_cache.get()
 
-        bills['gas'] = gas_difference * self.gas
-        bills['water'] = water_difference * self.water
-        bills['sdpt'], bills['garbage_removal'] = self.calculate_sdpt_garbage_removal(last_counters_created_date,
-                                                                                      self.sdpt, self.garbage_removal)
-        bills['heating'] = get_heating_bill()
-        bills['total'] = bills['flat'] + bills['electricity'] + bills['gas'] + bills['water'] + bills['sdpt'] + \
-                         bills['garbage_removal'] + bills['heating']
-        bills['last_counters_created_date'] = last_counters_created_date
+    @staticmethod
+    def get_flat_tariffs(flat_id, on=None):
+        """Returns {utility: Tariff} of the flat in effect on the date, today by default."""
+        return TariffTier.get_index().get_flat_tariffs(flat_id, on or date.today())
 
-        return bills
+    @staticmethod
+    def get_current_tiers(flat_id, utility, on, rates_tariff):
+        """Returns tiers of the version in effect on the date. Flat without versions gets the rates_tariff tiers,
+        they are saved as the version from the epoch, so that earlier bills keep them."""
+        tariff = TariffTier.get_index().find(flat_id, utility, on)
+        if tariff is None:
+            TariffTier.save_version(flat_id, utility, rates_tariff.tiers, EPOCH)
+            tariff = rates_tariff
+        return tariff.tiers
 
-    def commit(self):
-        session.add(self)
+    @staticmethod
+    def save_version(flat_id, utility, tiers, effective_from):
+        """Replace version of the flat utility from the date with [(start, price), ...] tiers."""
+        Tariff.from_tiers(tiers)
+        session.query(TariffTier).filter_by(flat_id=flat_id, utility=utility, effective_from=effective_from). \
+            delete(synchronize_session=False)
+        session.add_all([TariffTier(flat_id=flat_id, utility=utility, effective_from=effective_from, start=start,
+                                    price=price) for start, price in tiers])
         session.commit()
+        tariff_cache.invalidate()
+        render_cache.bump(flat_id)
 
 
 class FlatPayment(Base):
@@ -193,41 +550,35 @@ class FlatPayment(Base):
     __tablename__ = "flat_payments"
 
     id = Column(Integer, primary_key=True)
+    flat_id = Column(Integer, ForeignKey('flats.id'))
     month_number = Column(Integer, default=datetime.now().month)
     year = Column(Integer, default=datetime.now().year)
     is_paid = Column(Boolean, default=False)
-    __table_args__ = (UniqueConstraint('year', 'month_number', name='_year_month_uc'),)
+    __table_args__ = (UniqueConstraint('flat_id', 'year', 'month_number', name='_flat_year_month_uc'),
+                      Index('ix_flat_payments_flat_id_is_paid_year_month', 'flat_id', 'is_paid', 'year',
+                            'month_number'))
 
     def __repr__(self):
         return f"Paid {self.is_paid} {self.month_number}.{self.year}"
 
     @staticmethod
-    def generate_flat_payments():
-        """Try to load previous payments data."""
-        try:
-            from data.counters_data import LAST_PAYMENT_DATA as LPD
-            paid_months = session.query(FlatPayment).filter_by(year=LPD['year']).count()
-            if paid_months >= LPD['month_number']:
-                return
-            months = range(1, LPD['month_number'] + 1)
-            flat_payments = []
-            for m in months:
-                data = {'month_number': m, 'year': LPD['year'], 'is_paid': LPD['is_paid']}
-                flat_payments.append(FlatPayment(**data))
-
-            session.bulk_save_objects(flat_payments)
-            session.commit()
-        except ImportError:
-            print('Error. No data found.')
+    def upsert_mappings(rows):
+        """Insert or update payments by (flat_id, year, month_number). Returns numbers of inserted and updated rows."""
+        years = [row['year'] for row in rows]
+        existing = session.query(FlatPayment.id, FlatPayment.flat_id, FlatPayment.year, FlatPayment.month_number). \
+            filter(FlatPayment.flat_id.in_({row['flat_id'] for row in rows}),
+                   FlatPayment.year.between(min(years), max(years)))
+        return bulk_upsert(FlatPayment, rows, lambda row: (row['flat_id'], row['year'], row['month_number']),
+                           {tuple(key): payment_id for payment_id, *key in existing})
 
     @staticmethod
-    def get_this_year_payments():
-        return session.query(FlatPayment).filter_by(year=datetime.now().year, is_paid=True)
+    def get_this_year_payments(flat_id):
+        return session.query(FlatPayment).filter_by(flat_id=flat_id, year=datetime.now().year, is_paid=True)
 
     @staticmethod
-    def mark_as_paid_or_unpaid(month_number):
+    def mark_as_paid_or_unpaid(month_number, flat_id):
         """Set is_paid to opposite."""
-        month_data = {'month_number': month_number, 'year': datetime.now().year}
+        month_data = {'flat_id': flat_id, 'month_number': month_number, 'year': datetime.now().year}
         instance = session.query(FlatPayment).filter_by(**month_data).first()
         if instance:
             instance.is_paid = not instance.is_paid
@@ -239,18 +590,55 @@ class FlatPayment(Base):
         pass
 
     @staticmethod
-    def get_last_payment_date():
+    def mark_month_paid(year, month_number):
+        """Mark the month as paid for every flat with one update and one insert of the missing rows."""
+        table = FlatPayment.__table__
+        is_month = and_(table.c.year == year, table.c.month_number == month_number)
+        session.execute(table.update().where(is_month).values(is_paid=True))
+        missing = select([Flat.id, literal(year), literal(month_number), literal(True)]).where(
+            ~exists().where(and_(table.c.flat_id == Flat.id, is_month)))
+        session.execute(table.insert().from_select(['flat_id', 'year', 'month_number', 'is_paid'], missing))
+        session.commit()
+        for flat_id in Flat.get_flat_ids():
+            render_cache.bump(flat_id)
+
+    @staticmethod
+    def get_last_payment_date(flat_id):
         """Return number of the month when last payment was done."""
         # TODO: this should be private
-        last_payment = session.query(FlatPayment).filter_by(is_paid=True). \
+        last_payment = session.query(FlatPayment).filter_by(flat_id=flat_id, is_paid=True). \
             order_by(FlatPayment.year.desc(), FlatPayment.month_number.desc()).first()
         if not last_payment:
             raise ValueError
         return datetime(year=last_payment.year, month=last_payment.month_number, day=1)
 
+    @staticmethod
+    def get_last_payment_dates(flat_ids=None):
+        """Returns {flat_id: first day of the last paid month} of the flats, all by default, with one query.
+        Flats without payments are left out."""
+        month = func.max(FlatPayment.year * 12 + FlatPayment.month_number - 1)
+        rows = session.query(FlatPayment.flat_id, month).filter(FlatPayment.is_paid.is_(True))
+        if flat_ids is not None:
+            rows = rows.filter(FlatPayment.flat_id.in_(flat_ids))
+        rows = rows.group_by(FlatPayment.flat_id)
+        return {flat_id: datetime(year=month // 12, month=month % 12 + 1, day=1) for flat_id, month in rows}
+
+    @staticmethod
+    def get_history(flat_id, since=None, until=None, batch_size=1000):
+        """Returns query of (year, month_number, is_paid) tuples between the dates, streamed by batch_size rows."""
+        query = session.query(FlatPayment.year, FlatPayment.month_number, FlatPayment.is_paid).filter(
+            FlatPayment.flat_id == flat_id)
+        year_month = FlatPayment.year * 100 + FlatPayment.month_number
+        if since:
+            query = query.filter(year_month >= since.year * 100 + since.month)
+        if until:
+            query = query.filter(year_month <= until.year * 100 + until.month)
+        return query.order_by(FlatPayment.year, FlatPayment.month_number).yield_per(batch_size)
+
     def commit(self):
         session.add(self)
         session.commit()
+        render_cache.bump(self.flat_id)
 
 
 class Counters(Base):
@@ -263,17 +651,23 @@ class Counters(Base):
     gas = Column(Integer)
     water = Column(Integer)
     user_id = Column(Integer, ForeignKey('users.user_id'))
+    flat_id = Column(Integer, ForeignKey('flats.id'))
     gas_counter_photo_url = Column(String)
+    gas_counter_photo_file_id = Column(String)
+    gas_counter_photo_path = Column(String)
+    gas_counter_photo_thumb_path = Column(String)
     created = Column(DateTime(timezone=True), server_default=func.now())
     updated = Column(DateTime(timezone=True), onupdate=func.now())
+    __table_args__ = (Index('ix_counters_flat_id_updated', 'flat_id', 'updated'),
+                      Index('ix_counters_flat_id_created', 'flat_id', 'created'))
 
     def __repr__(self):
         return f"Counters {self.updated} from {self.user_id}"
 
     @staticmethod
-    def get_last_and_previous_user_counters(user_id):
-        """Returns last counters and previous counters data for specific user."""
-        counters = session.query(Counters).filter_by(user_id=user_id).order_by(Counters.updated.desc()).limit(2).all()
+    def get_last_and_previous_flat_counters(flat_id):
+        """Returns last counters and previous counters data for specific flat."""
+        counters = session.query(Counters).filter_by(flat_id=flat_id).order_by(Counters.updated.desc()).limit(2).all()
         counters_last, counters_previous = None, None
 
         try:
@@ -284,9 +678,28 @@ class Counters(Base):
         return counters_last, counters_previous
 
     @staticmethod
-    def get_last_user_counters(user_id):
-        """Returns last counters data for specific user."""
-        return session.query(Counters).filter_by(user_id=user_id).order_by(desc(Counters.updated)).first()
+    def get_last_and_previous_counters(flat_ids=None):
+        """Returns {flat_id: (last, previous)} counters rows of the flats, all by default, with one windowed query.
+        Rows have id, electricity, gas, water, created and gas_counter_photo_url. Flats without counters are left out,
+        missing previous ones are None."""
+        position = func.row_number().over(partition_by=Counters.flat_id,
+                                           order_by=(Counters.updated.desc(), Counters.id.desc())).label('position')
+        ranked = session.query(Counters.flat_id, Counters.id, Counters.electricity, Counters.gas, Counters.water,
+                               Counters.created, Counters.gas_counter_photo_url, position). \
+            filter(Counters.flat_id.isnot(None))
+        if flat_ids is not None:
+            ranked = ranked.filter(Counters.flat_id.in_(flat_ids))
+        ranked = ranked.subquery()
+
+        counters = {}
+        for row in session.query(ranked).filter(ranked.c.position <= 2):
+            counters.setdefault(row.flat_id, [None, None])[row.position - 1] = row
+        return {flat_id: tuple(rows) for flat_id, rows in counters.items()}
+
+    @staticmethod
+    def get_last_flat_counters(flat_id):
+        """Returns last counters data for specific flat."""
+        return session.query(Counters).filter_by(flat_id=flat_id).order_by(desc(Counters.updated)).first()
 
     @staticmethod
     def calculate_counters_difference(*counters):
@@ -302,37 +715,269 @@ class Counters(Base):
         return electricity, gas, water, counters_last_created
 
     @staticmethod
-    def get_last_values_difference(user_id):
+    def get_last_values_difference(flat_id):
         """Returns last indications."""
-        counters = Counters.get_last_and_previous_user_counters(user_id)
+        counters = Counters.get_last_and_previous_flat_counters(flat_id)
         return Counters.calculate_counters_difference(*counters)
 
     @staticmethod
-    def get_current_month_counters_data(user_id):
+    def get_current_month_counters_data(flat_id):
         """Returns counters data for current month."""
         first_day_of_month = datetime.today().replace(day=1)
         return session.query(Counters).filter(
-            Counters.created >= first_day_of_month,
-            user_id == user_id).first()
+            Counters.flat_id == flat_id,
+            Counters.created >= first_day_of_month).first()
 
     @staticmethod
-    def load_previous_counters_data(user):
-        """Try to load previous counters data."""
-        try:
-            from data.counters_data import DATA
-            counters_list = []
-            for d in DATA:
-                counters = Counters(**d)
-                counters.user_id = user.user_id
-                counters_list.append(counters)
-            session.bulk_save_objects(counters_list)
-            session.commit()
-        except ImportError:
-            print('No data found.')
+    def set_photo(counters_id, url, path, thumb_path):
+        """Save downloaded gas counter photo. Paths are relative to the photo store."""
+        counters = session.query(Counters).get(counters_id)
+        counters.gas_counter_photo_url = url
+        counters.gas_counter_photo_path = path
+        counters.gas_counter_photo_thumb_path = thumb_path
+        counters.commit()
+        return counters
+
+    @staticmethod
+    def get_history(flat_id, since=None, until=None, batch_size=1000):
+        """Returns query of (created, electricity, gas, water) tuples created between the dates,
+        streamed by batch_size rows."""
+        query = session.query(Counters.created, Counters.electricity, Counters.gas, Counters.water).filter(
+            Counters.flat_id == flat_id)
+        if since:
+            query = query.filter(Counters.created >= since)
+        if until:
+            query = query.filter(Counters.created < until)
+        return query.order_by(Counters.created).yield_per(batch_size)
+
+    @staticmethod
+    def upsert_mappings(rows):
+        """Insert or update counters by (flat_id, created). Returns numbers of inserted and updated rows."""
+        created = [row['created'] for row in rows]
+        existing = session.query(Counters.id, Counters.flat_id, Counters.created).filter(
+            Counters.flat_id.in_({row['flat_id'] for row in rows}), Counters.created.between(min(created), max(created)))
+        return bulk_upsert(Counters, rows, lambda row: (row['flat_id'], row['created']),
+                           {(flat_id, created.replace(tzinfo=None)): counters_id
+                            for counters_id, flat_id, created in existing})
+
+    def commit(self):
+        session.add(self)
+        session.commit()
+        render_cache.bump(self.flat_id)
+
+
+class HeatingBill(Base):
+    """Heating bill sum for the account and billing month."""
+
+    __tablename__ = "heating_bills"
+
+    id = Column(Integer, primary_key=True)
+    account = Column(String, nullable=False)
+    year = Column(Integer, nullable=False)
+    month_number = Column(Integer, nullable=False)
+    sum_topay = Column(Float)
+    created = Column(DateTime(timezone=True), server_default=func.now())
+    __table_args__ = (UniqueConstraint('account', 'year', 'month_number', name='_account_year_month_uc'),)
+
+    def __repr__(self):
+        return f"Heating {self.sum_topay} {self.month_number}.{self.year}"
+
+    @staticmethod
+    def get_sum_topay(account, year, month_number):
+        """Returns saved sum for the billing month or None."""
+        return session.query(HeatingBill.sum_topay).filter_by(
+            account=account, year=year, month_number=month_number).scalar()
+
+    @staticmethod
+    def save(account, year, month_number, sum_topay):
+        """Save sum for the billing month."""
+        HeatingBill(account=account, year=year, month_number=month_number, sum_topay=sum_topay).commit()
 
     def commit(self):
         session.add(self)
         session.commit()
 
 
-Base.metadata.create_all(engine)
+class BillSnapshot(Base):
+    """Bill issued for the flat. Calculated when renter sends new counters data or rates/payments change,
+    so showing the bill is one indexed lookup. Rows are never updated and keep history of issued bills."""
+
+    __tablename__ = "bill_snapshots"
+
+    COUNTERS, RATES, PAYMENT, REFRESH, BILLING = 'counters', 'rates', 'payment', 'refresh', 'billing'
+    BILL_FIELDS = ('flat', 'electricity', 'gas', 'water', 'sdpt', 'garbage_removal', 'heating', 'total')
+
+    id = Column(Integer, primary_key=True)
+    flat_id = Column(Integer, ForeignKey('flats.id'), nullable=False)
+    counters_id = Column(Integer, ForeignKey('counters.id'))
+    rates_version = Column(Integer)
+    reason = Column(String)
+    flat_price = Column(Float)
+    exchange_rate = Column(Float)
+    flat = Column(Float)
+    electricity = Column(Float)
+    gas = Column(Float)
+    water = Column(Float)
+    sdpt = Column(Float)
+    garbage_removal = Column(Float)
+    heating = Column(Float)
+    total = Column(Float)
+    pending = Column(String)
+    last_counters_created = Column(DateTime(timezone=True))
+    created = Column(DateTime(timezone=True), server_default=func.now())
+    __table_args__ = (Index('ix_bill_snapshots_flat_id_id', 'flat_id', 'id'),)
+
+    def __repr__(self):
+        return f"Bill {self.total} for flat {self.flat_id} ({self.reason})"
+
+    @staticmethod
+    def to_row(flat_id, rates_version, flat_price, exchange_rate, bills, reason, counters_id=None):
+        """Returns columns of the bill calculated by RatesMixin.calculate_total_price."""
+        return dict(flat_id=flat_id, rates_version=rates_version, flat_price=flat_price, exchange_rate=exchange_rate,
+                    reason=reason, counters_id=counters_id, pending=','.join(bills['pending']),
+                    last_counters_created=bills['last_counters_created_date'],
+                    **{field: bills[field] for field in BillSnapshot.BILL_FIELDS})
+
+    @staticmethod
+    def save(flat_id, rates_version, flat_price, exchange_rate, bills, reason, counters_id=None):
+        """Save bill calculated by RatesMixin.calculate_total_price."""
+        snapshot = BillSnapshot(**BillSnapshot.to_row(flat_id, rates_version, flat_price, exchange_rate, bills, reason,
+                                                      counters_id))
+        snapshot.commit()
+        return snapshot
+
+    @staticmethod
+    def save_many(rows):
+        """Insert BillSnapshot.to_row rows with one executemany."""
+        if rows:
+            session.execute(BillSnapshot.__table__.insert(), rows)
+        session.commit()
+
+    @staticmethod
+    def get_last(flat_id):
+        """Returns latest bill of the flat or None."""
+        return session.query(BillSnapshot).filter_by(flat_id=flat_id).order_by(BillSnapshot.id.desc()).first()
+
+    @staticmethod
+    def get_history(flat_id, since=None, until=None, batch_size=1000):
+        """Returns query of (created, reason, flat_price, exchange_rate, *BILL_FIELDS, pending) tuples of bills
+        calculated between the dates, streamed by batch_size rows."""
+        query = session.query(BillSnapshot.created, BillSnapshot.reason, BillSnapshot.flat_price,
+                              BillSnapshot.exchange_rate,
+                              *(getattr(BillSnapshot, field) for field in BillSnapshot.BILL_FIELDS),
+                              BillSnapshot.pending).filter(BillSnapshot.flat_id == flat_id)
+        if since:
+            query = query.filter(BillSnapshot.created >= since)
+        if until:
+            query = query.filter(BillSnapshot.created < until)
+        return query.order_by(BillSnapshot.id).yield_per(batch_size)
+
+    def get_pending(self):
+        return self.pending.split(',') if self.pending else []
+
+    def get_bills(self):
+        """Returns bills in the same shape as RatesMixin.calculate_total_price."""
+        bills = {field: getattr(self, field) for field in BillSnapshot.BILL_FIELDS}
+        bills['pending'] = self.get_pending()
+        bills['last_counters_created_date'] = self.last_counters_created
+        return bills
+
+    def commit(self):
+        session.add(self)
+        session.commit()
+
+
+class EmailOutbox(Base):
+    """Emails waiting to be sent. Handlers only add rows, mail.drain_outbox sends them in background."""
+
+    __tablename__ = "email_outbox"
+
+    PENDING, SENT, DEAD = 'pending', 'sent', 'dead'
+
+    id = Column(Integer, primary_key=True)
+    subject = Column(String)
+    body = Column(Text)
+    template_id = Column(String)
+    template_data = Column(Text)
+    attachment_path = Column(String)
+    status = Column(String, nullable=False, default=PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    created = Column(DateTime(timezone=True), server_default=func.now())
+    sent_at = Column(DateTime)
+    __table_args__ = (Index('ix_email_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),)
+
+    def __repr__(self):
+        return f"Email {self.id} {self.status} '{self.subject}'"
+
+    @staticmethod
+    def enqueue(subject, body=None, template_id=None, template_data=None, attachment_path=None):
+        """Add email to the outbox."""
+        email = EmailOutbox(subject=subject, body=body, template_id=template_id,
+                            template_data=json.dumps(template_data) if template_data else None,
+                            attachment_path=attachment_path)
+        email.commit()
+        return email
+
+    @staticmethod
+    def enqueue_many(emails):
+        """Add emails to the outbox with one executemany. emails are dicts of the enqueue arguments."""
+        rows = [{'subject': email['subject'], 'body': email.get('body'), 'template_id': email.get('template_id'),
+                 'template_data': json.dumps(email['template_data']) if email.get('template_data') else None,
+                 'attachment_path': email.get('attachment_path')} for email in emails]
+        if rows:
+            session.execute(EmailOutbox.__table__.insert(), rows)
+        session.commit()
+
+    @staticmethod
+    def get_due(limit):
+        """Returns pending emails which should be sent now, oldest first."""
+        return session.query(EmailOutbox).filter(
+            EmailOutbox.status == EmailOutbox.PENDING,
+            EmailOutbox.next_attempt_at <= datetime.utcnow()).order_by(EmailOutbox.next_attempt_at).limit(limit).all()
+
+    def get_template_data(self):
+        return json.loads(self.template_data) if self.template_data else None
+
+    def mark_sent(self):
+        self.status = EmailOutbox.SENT
+        self.sent_at = datetime.utcnow()
+        self.last_error = None
+
+    def mark_failed(self, error, max_attempts, backoff, max_backoff):
+        """Schedule retry with exponential backoff. Move to dead letters after max_attempts."""
+        self.attempts += 1
+        self.last_error = str(error)
+
+        if self.attempts >= max_attempts:
+            self.status = EmailOutbox.DEAD
+        else:
+            delay = min(backoff * 2 ** (self.attempts - 1), max_backoff)
+            self.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+
+    def commit(self):
+        session.add(self)
+        session.commit()
+
+
+# Rates change a couple of times a year, so bills use in-memory snapshot.
+# Rates version is re-checked in background every RATES_CACHE_TTL seconds to catch changes made directly in DB.
+rates_cache = TTLCache(Rates.load_flat_rates, RATES_CACHE_TTL, name='rates')
+
+# Tariff versions of all flats, they change even more rarely than rates. Dropped when a version is saved.
+tariff_cache = TTLCache(TariffTier.load_index, RATES_CACHE_TTL, name='tariffs')
+
+# Flat membership changes rarely. Entries are dropped when user or flat is saved.
+flat_cache = TTLCache(Flat.load_by_chat_id, FLAT_CACHE_TTL, name='flats')
+
+# Rendered counters, rates and payments messages of every flat. Dropped by commit() of the data behind them.
+render_cache = RenderCache(RENDER_CACHE_TTL, name='render')
+
+# Every user, so that entering the conversation doesn't touch DB. Warmed on start, updated by User.save_profile.
+user_registry = Registry(User.load_all, key=lambda user_info: user_info.user_id, name='users')
+
+
+def create_schema():
+    """Create missing tables. Real deployments get schema from `alembic upgrade head` instead."""
+    Base.metadata.create_all(engine)
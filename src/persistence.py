@@ -0,0 +1,153 @@
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+from collections import defaultdict
+
+from telegram.ext import BasePersistence
+
+logger = logging.getLogger(__name__)
+
+USER_DATA = 'user_data'
+
+
+class SQLitePersistence(BasePersistence):
+    """Keeps conversation states and user_data in one small SQLite table.
+
+    Dispatcher reports state after every update, but only values that really changed are marked dirty.
+    Dirty values are written in background every `flush_interval` seconds in one transaction, and on shutdown.
+    """
+
+    def __init__(self, path, flush_interval=1.0):
+        super().__init__(store_user_data=True, store_chat_data=False)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS bot_state ('
+                                'kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+                                'PRIMARY KEY (kind, key)) WITHOUT ROWID')
+        self.connection.commit()
+        self._saved = {}
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically, name='persistence', daemon=True)
+        self._flusher.start()
+
+    def _load(self, kind):
+        rows = self.connection.execute('SELECT key, value FROM bot_state WHERE kind = ?', (kind,)).fetchall()
+        with self._lock:
+            for key, value in rows:
+                self._saved[(kind, key)] = value
+        return [(json.loads(key), json.loads(value)) for key, value in rows]
+
+    def _update(self, kind, key, value):
+        """Mark value dirty if it differs from the saved one. None or empty dict removes the row.
+        Conversation state 0 (CHOOSING) is a real state and is kept."""
+        key = json.dumps(key)
+        value = None if value is None or value == {} else json.dumps(value, sort_keys=True, separators=(',', ':'))
+        with self._lock:
+            if self._saved.get((kind, key)) == value:
+                self._dirty.pop((kind, key), None)
+            else:
+                self._dirty[(kind, key)] = value
+
+    def get_user_data(self):
+        user_data = defaultdict(dict)
+        for user_id, data in self._load(USER_DATA):
+            user_data[user_id] = data
+        return user_data
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_conversations(self, name):
+        return {tuple(key): state for key, state in self._load(f'conversation:{name}')}
+
+    def update_conversation(self, name, key, new_state):
+        while isinstance(new_state, tuple):
+            # (old state, Promise) while a run_async handler works, the new state is reported once it is done.
+            new_state = new_state[0]
+        self._update(f'conversation:{name}', list(key), new_state)
+
+    def update_user_data(self, user_id, data):
+        self._update(USER_DATA, user_id, data)
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def flush(self):
+        """Write dirty values now."""
+        with self._write_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return
+
+            upserts = [(kind, key, value) for (kind, key), value in dirty.items() if value is not None]
+            deletes = [(kind, key) for (kind, key), value in dirty.items() if value is None]
+            try:
+                with self.connection:
+                    self.connection.executemany('INSERT OR REPLACE INTO bot_state (kind, key, value) VALUES (?, ?, ?)',
+                                                upserts)
+                    self.connection.executemany('DELETE FROM bot_state WHERE kind = ? AND key = ?', deletes)
+            except sqlite3.Error:
+                # Keep them for the next flush unless they were changed meanwhile.
+                with self._lock:
+                    self._dirty = {**dirty, **self._dirty}
+                raise
+
+            with self._lock:
+                for item, value in dirty.items():
+                    self._saved[item] = value
+
+    def stop(self):
+        """Stop background writes and write everything that is left."""
+        self._stopped.set()
+        self._flusher.join()
+        self.flush()
+
+    def _flush_periodically(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logger.error('Could not save bot state: %s', e)
+
+
+def check_round_trip():
+    """Save conversation states and user_data, load them with a new instance. Returns names of lost values."""
+    from constants import CHOOSING, TYPING_REPLY
+
+    expected = {'CHOOSING': ((1, 1), CHOOSING), 'TYPING_REPLY': ((2, 2), TYPING_REPLY)}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'state.sqlite')
+        persistence = SQLitePersistence(path)
+        for key, state in expected.values():
+            persistence.update_conversation('check', key, state)
+        persistence.update_user_data(1, {'choice': 'Вода'})
+        persistence.stop()
+
+        loaded = SQLitePersistence(path)
+        conversations = loaded.get_conversations('check')
+        user_data = loaded.get_user_data()
+        loaded.stop()
+        loaded.connection.close()
+        persistence.connection.close()
+
+    lost = [name for name, (key, state) in expected.items() if conversations.get(key) != state]
+    if user_data.get(1) != {'choice': 'Вода'}:
+        lost.append('user_data')
+    return lost
+
+
+if __name__ == '__main__':
+    lost_values = check_round_trip()
+    if lost_values:
+        print(f"Lost after save/load: {', '.join(lost_values)}")
+        sys.exit(1)
+    print('Conversation states and user_data survive save/load')
@@ -0,0 +1,71 @@
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import models
+from settings import PHOTO_STORE_DIR, PHOTO_WORKERS
+
+logger = logging.getLogger(__name__)
+
+photo_executor = ThreadPoolExecutor(max_workers=PHOTO_WORKERS, thread_name_prefix='photo')
+
+
+def store(data, suffix='.jpg'):
+    """Save bytes to content-addressed store. Returns path relative to PHOTO_STORE_DIR.
+    Same content is stored once, so re-sent photos don't take extra space."""
+    digest = hashlib.sha256(data).hexdigest()
+    relative_path = os.path.join(digest[:2], digest + suffix)
+    path = os.path.join(PHOTO_STORE_DIR, relative_path)
+
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return relative_path
+
+
+def get_store_path(relative_path):
+    return os.path.join(PHOTO_STORE_DIR, relative_path)
+
+
+def download(bot, file_id):
+    """Download file from Telegram. Returns content and Telegram file url."""
+    with metrics.timer(metrics.HTTP_REQUEST_DURATION, upstream='telegram'):
+        telegram_file = bot.get_file(file_id)
+        return bytes(telegram_file.download_as_bytearray()), telegram_file.file_path
+
+
+@models.with_session
+def ingest_counters_photo(bot, counters_id, photo_sizes, on_done=None):
+    """Download largest photo size and the smallest one as thumbnail, save them on Counters.
+    on_done is called with the Counters row, also when download failed."""
+    try:
+        data, file_url = download(bot, photo_sizes[-1].file_id)
+        photo_path = store(data)
+        thumb_path = None
+        if len(photo_sizes) > 1:
+            thumb_data, _ = download(bot, photo_sizes[0].file_id)
+            thumb_path = store(thumb_data)
+        counters = models.Counters.set_photo(counters_id, file_url, photo_path, thumb_path)
+    except Exception as e:
+        logger.exception('Could not ingest photo for counters %s: %s', counters_id, e)
+        counters = models.session.query(models.Counters).get(counters_id)
+
+    if on_done:
+        on_done(counters)
+
+
+def log_error(future):
+    if future.exception():
+        logger.error('Photo ingestion failed: %s', future.exception())
+
+
+def submit_counters_photo(bot, counters_id, photo_sizes, on_done=None):
+    """Ingest photo in background. Returns future."""
+    future = photo_executor.submit(ingest_counters_photo, bot, counters_id, list(photo_sizes), on_done)
+    future.add_done_callback(log_error)
+    return future
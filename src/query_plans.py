@@ -0,0 +1,68 @@
+"""Print query plans for the hot counters/payments/bill lookups.
+
+Usage: python query_plans.py
+
+Exits with code 1 if on SQLite any of the lookups scans a whole table or sorts in a temp b-tree,
+i.e. it is not covered by an index anymore.
+"""
+import sys
+from datetime import datetime
+
+import models
+from models import Counters, FlatPayment, Rates, Flat, User, BillSnapshot
+
+# Same shape as the queries in the models methods with the same names.
+HOT_QUERIES = {
+    'Counters.get_last_flat_counters': lambda s: s.query(Counters).filter_by(flat_id=1).order_by(
+        Counters.updated.desc()).limit(1),
+    'Counters.get_last_and_previous_flat_counters': lambda s: s.query(Counters).filter_by(flat_id=1).order_by(
+        Counters.updated.desc()).limit(2),
+    'Counters.get_current_month_counters_data': lambda s: s.query(Counters).filter(
+        Counters.flat_id == 1, Counters.created >= datetime.today().replace(day=1)).limit(1),
+    'FlatPayment.get_this_year_payments': lambda s: s.query(FlatPayment).filter_by(
+        flat_id=1, year=datetime.now().year, is_paid=True),
+    'FlatPayment.get_last_payment_date': lambda s: s.query(FlatPayment).filter_by(flat_id=1, is_paid=True).order_by(
+        FlatPayment.year.desc(), FlatPayment.month_number.desc()).limit(1),
+    'Rates.load_flat_rates': lambda s: s.query(Rates.version).filter(Rates.flat_id == 1),
+    'Flat.load_by_chat_id': lambda s: s.query(Flat).join(User, User.flat_id == Flat.id).filter(User.chat_id == 1),
+    'BillSnapshot.get_last': lambda s: s.query(BillSnapshot).filter_by(flat_id=1).order_by(
+        BillSnapshot.id.desc()).limit(1),
+}
+
+
+def explain(query):
+    """Return list of plan rows for the ORM query."""
+    compiled = query.statement.compile(dialect=models.engine.dialect)
+    if compiled.positional:
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+    else:
+        params = compiled.params
+    prefix = 'EXPLAIN QUERY PLAN ' if models.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+    return [' '.join(str(column) for column in row) for row in models.engine.execute(prefix + str(compiled), params)]
+
+
+def is_unindexed(plan_row):
+    """Full table scan or sort without index in SQLite plan."""
+    plan_row = plan_row.upper()
+    return ('SCAN' in plan_row and 'USING' not in plan_row) or 'TEMP B-TREE' in plan_row
+
+
+@models.with_session
+def check_query_plans():
+    """Print plan for every hot query. Returns names of the queries that are not covered by index."""
+    unindexed = []
+    for name, build_query in HOT_QUERIES.items():
+        plan = explain(build_query(models.session))
+        print(name)
+        for row in plan:
+            print(f'    {row}')
+        if models.engine.dialect.name == 'sqlite' and any(is_unindexed(row) for row in plan):
+            unindexed.append(name)
+    return unindexed
+
+
+if __name__ == '__main__':
+    not_covered = check_query_plans()
+    if not_covered:
+        print(f"Not covered by index: {', '.join(not_covered)}")
+        sys.exit(1)
@@ -0,0 +1,53 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second with bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take one token and return how many seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self):
+        """Block until a token is available."""
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """Make everyone wait at least `seconds`, e.g. after Telegram's RetryAfter."""
+        with self._lock:
+            self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+
+class RateLimiter:
+    """Global plus per-chat token buckets, e.g. Telegram's ~30 msg/s per bot and ~1 msg/s per chat."""
+
+    def __init__(self, global_rate, per_chat_rate, per_chat_capacity=None):
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_capacity = per_chat_capacity
+        self._chat_buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, chat_id):
+        """Block until message to chat_id can be sent."""
+        with self._lock:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_capacity)
+        bucket.acquire()
+        self.global_bucket.acquire()
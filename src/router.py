@@ -0,0 +1,46 @@
+from telegram import Update
+from telegram.ext import Handler
+
+
+class Router(Handler):
+    """Routes text messages to callbacks by button text with one dict lookup.
+
+    Texts that are not exactly a button (e.g. typed by hand) go to the first route whose text they contain,
+    same as the chain of regex handlers did. Everything else goes to default callback.
+    """
+
+    def __init__(self, routes, default=None):
+        super().__init__(self.dispatch)
+        self.routes = dict(routes)
+        self.default = default
+        # Plain substring checks are faster than one alternation regex, re doesn't optimize literal alternatives.
+        self._fallback = tuple(self.routes.items())
+
+    def resolve(self, text):
+        """Returns callback for the text or default one."""
+        callback = self.routes.get(text)
+        if callback is not None:
+            return callback
+
+        for route, callback in self._fallback:
+            if route in text:
+                return callback
+        return self.default
+
+    def map_callbacks(self, wrap):
+        """Replace every callback with wrap(callback), e.g. to instrument them."""
+        self.routes = {route: wrap(callback) for route, callback in self.routes.items()}
+        self.default = wrap(self.default) if self.default is not None else None
+        self._fallback = tuple(self.routes.items())
+
+    def check_update(self, update):
+        # Only messages, like MessageHandler(Filters.text): callback query carries the text of the bot's own message.
+        if isinstance(update, Update) and update.message and update.message.text:
+            return self.resolve(update.message.text)
+        return None
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        return check_result(update, context)
+
+    def dispatch(self, update, context):
+        return self.resolve(update.message.text)(update, context)
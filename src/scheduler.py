@@ -1,39 +1,86 @@
+import logging
 from datetime import datetime
 
 import telegram
-from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
-from apscheduler.schedulers.background import BackgroundScheduler
-from pytz import utc
 
+import metrics
 import models
 from mail import send_email
-from settings import DB_URL, TELEGRAM_TOKEN, RENTER_USERNAME
+from sender import send_queue
+from settings import TELEGRAM_TOKEN
 
-jobstores = {
-    'default': SQLAlchemyJobStore(url=DB_URL)
-}
-scheduler = BackgroundScheduler(jobstores=jobstores, timezone=utc)
+logger = logging.getLogger(__name__)
 
+REMINDER_TEXT = "Привет-привет!)\nОтправь мне пожалуйста показания счетчиков) заранее спасибо <3"
 
-def ask_for_counters_data():
-    """Send message to renter reminding to submit new counters data."""
-    user = models.User.get_user_by_username(RENTER_USERNAME)
+_bot = None
+_scheduler = None
+
+
+def get_scheduler():
+    """Return background scheduler. It is created on first use, jobs are stored in the bot DB."""
+    global _scheduler
+    if _scheduler is None:
+        from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+        from apscheduler.schedulers.background import BackgroundScheduler
+        from pytz import utc
 
-    if not user or not user.chat_id:
-        return
+        _scheduler = BackgroundScheduler(jobstores={'default': SQLAlchemyJobStore(engine=models.engine)},
+                                         timezone=utc)
+    return _scheduler
 
-    counters_data_this_month = models.Counters.get_current_month_counters_data(user.chat_id)
 
-    if not counters_data_this_month:
-        bot = telegram.Bot(token=TELEGRAM_TOKEN)
-        bot.send_message(chat_id=user.chat_id, text="Привет-привет!)")
-        bot.send_message(chat_id=user.chat_id, text="Отправь мне пожалуйста показания счетчиков) заранее спасибо <3")
+def set_bot(bot):
+    """Share bot client of the updater with scheduler jobs."""
+    global _bot
+    _bot = bot
 
 
+def get_bot():
+    """Return shared bot client. Created once if updater did not provide one."""
+    global _bot
+    if _bot is None:
+        _bot = telegram.Bot(token=TELEGRAM_TOKEN)
+    return _bot
+
+
+@models.with_session
+def ask_for_counters_data():
+    """Send message to every renter who has not submitted counters data this month."""
+    first_day_of_month = datetime.today().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    renters = models.User.get_renters_without_counters(first_day_of_month)
+    # Sending takes a while, don't hold DB connection meanwhile.
+    models.Session.remove()
+
+    # Send queue respects rate limits and retries when Telegram asks to slow down.
+    bot = get_bot()
+    sent = failed = 0
+    futures = [send_queue.send(bot, chat_id, REMINDER_TEXT) for user_id, chat_id in renters]
+    for i, future in enumerate(futures, 1):
+        # Any error of one recipient (logged by the queue) must not stop reminders of the rest.
+        try:
+            future.result()
+            sent += 1
+            metrics.registry.inc(metrics.REMINDERS, status='sent')
+        except Exception:
+            failed += 1
+            metrics.registry.inc(metrics.REMINDERS, status='failed')
+        if i % 100 == 0:
+            logger.info('Reminders progress: %s/%s sent, %s failed', sent, len(renters), failed)
+
+    logger.info('Reminders done: %s/%s sent, %s failed', sent, len(renters), failed)
+
+
+@models.with_session
 def mark_as_paid():
-    """Automatically mark every month as paid. Send email with notification."""
-    current_month_number = datetime.now().month
-    models.FlatPayment.mark_as_paid_or_unpaid(current_month_number)
-    current_month = datetime.now().strftime("%B")
+    """Automatically mark every month as paid for every flat and issue new bills. Send email with notification.
+    Bills of all flats are calculated by one billing run, exchange rate and heating bills are fetched once."""
+    import billing
+
+    now = datetime.now()
+    current_month = now.strftime("%B")
+    models.FlatPayment.mark_month_paid(now.year, now.month)
+    billed, _, stage = billing.run(reason=models.BillSnapshot.PAYMENT)
+    logger.info('Marked %s as paid, billed %s flats: %s', current_month, billed, stage.format())
     send_email(f'{current_month} отмечен как оплаченный.',
                'Для отмены <b>Оплачено > выбрать месяц, который не оплачен </b>')
@@ -0,0 +1,229 @@
+"""Outbound Telegram messages, documents and chat actions.
+
+Handlers and jobs put messages to the send queue and return, workers deliver them. The first message to a chat goes
+right away. Text messages queued while the chat is busy sending (e.g. waiting for its per-chat rate limit) go as one
+message when they are sent the same way (options and keyboard), so a chat gets fewer messages and its flood limit is
+hit less often. A chat action followed by a message is not sent at all. Everything sent to one chat keeps its order,
+it is sent by one worker at a time. Workers respect the global and per-chat rate limits (chat actions only the global
+one) and wait as long as Telegram's RetryAfter asks.
+"""
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import Future
+
+from telegram.error import RetryAfter
+
+import metrics
+from ratelimit import RateLimiter
+from settings import TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, SEND_WORKERS, SEND_MAX_ATTEMPTS
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+
+# method is the name of the telegram.Bot method, options are its arguments besides chat_id.
+OutgoingMessage = namedtuple('OutgoingMessage', ('bot', 'method', 'options', 'future'))
+
+
+def without_text(options):
+    return {name: value for name, value in options.items() if name != 'text'}
+
+
+def can_merge(first, second):
+    """Text messages can go as one when they are sent the same way, with the same keyboard too."""
+    if first.method != 'send_message' or second.method != 'send_message' or first.bot is not second.bot:
+        return False
+    if len(first.options['text']) + len(second.options['text']) + 1 > MAX_MESSAGE_LENGTH:
+        return False
+    return without_text(first.options) == without_text(second.options)
+
+
+def skip_outdated_actions(messages):
+    """Chat action is pointless once a message follows it. Returns messages to send, skipped ones are resolved."""
+    kept = []
+    for i, message in enumerate(messages):
+        if message.method == 'send_chat_action' and i + 1 < len(messages):
+            message.future.set_result(True)
+        else:
+            kept.append(message)
+    return kept
+
+
+def coalesce(messages):
+    """Group consecutive messages that can be sent as one. Repeated texts are sent once."""
+    batches = []
+    for message in messages:
+        if batches and can_merge(batches[-1][-1], message):
+            batches[-1].append(message)
+        else:
+            batches.append([message])
+    return batches
+
+
+def merge(batch):
+    """Returns options of the one message for the batch."""
+    if len(batch) == 1:
+        return batch[0].options
+    texts = [message.options['text'] for i, message in enumerate(batch)
+             if i == 0 or message.options['text'] != batch[i - 1].options['text']]
+    return {**batch[0].options, 'text': '\n'.join(texts)}
+
+
+class SendQueue:
+    """Queue of outgoing messages by chat, delivered by a pool of worker threads started on the first message."""
+
+    def __init__(self, rate_limiter, workers, max_attempts):
+        self.rate_limiter = rate_limiter
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._pending = {}
+        self._busy = set()
+        self._ready = deque()
+        self._threads = []
+        self._stopping = False
+        self._cond = threading.Condition()
+
+    def send(self, bot, chat_id, text, **options):
+        """Queue text message to the chat. Returns future of the sent telegram.Message."""
+        return self.submit(bot, 'send_message', chat_id, text=text, **options)
+
+    def submit(self, bot, method, chat_id, **options):
+        """Queue call of the bot method for the chat, e.g. send_document. Returns future of its result."""
+        message = OutgoingMessage(bot, method, options, Future())
+        with self._cond:
+            self._start()
+            messages = self._pending.setdefault(chat_id, [])
+            messages.append(message)
+            # Busy chat is picked up again when its worker is done, with everything queued meanwhile.
+            if len(messages) == 1 and chat_id not in self._busy:
+                self._schedule(chat_id)
+        return message.future
+
+    def flush(self, timeout=None):
+        """Wait until every queued message is sent. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self, timeout=None):
+        """Send queued messages and stop the workers."""
+        self.flush(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join(timeout)
+        with self._cond:
+            self._stopping = False
+
+    def _start(self):
+        """Start workers unless they are running. Must hold the lock."""
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'send-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _schedule(self, chat_id):
+        """Must hold the lock."""
+        self._ready.append(chat_id)
+        self._cond.notify()
+
+    def _next_chat(self):
+        """Wait for a chat with queued messages. None when stopping."""
+        with self._cond:
+            while True:
+                if self._stopping:
+                    return None
+                if self._ready:
+                    chat_id = self._ready.popleft()
+                    self._busy.add(chat_id)
+                    return chat_id, self._pending.pop(chat_id)
+                self._cond.wait()
+
+    def _work(self):
+        while True:
+            next_chat = self._next_chat()
+            if next_chat is None:
+                return
+            chat_id, messages = next_chat
+            try:
+                batches = coalesce(skip_outdated_actions(messages))
+                metrics.registry.inc(metrics.MESSAGES_COALESCED, len(messages) - len(batches))
+                for batch in batches:
+                    self._deliver(chat_id, batch)
+            except Exception as e:
+                # Nobody waits forever for a message that was lost on the way.
+                logger.exception('Could not send messages to %s', chat_id)
+                for message in messages:
+                    if not message.future.done():
+                        message.future.set_exception(e)
+            finally:
+                with self._cond:
+                    self._busy.discard(chat_id)
+                    if chat_id in self._pending:
+                        self._schedule(chat_id)
+                    self._cond.notify_all()
+
+    def _deliver(self, chat_id, batch):
+        """Send the batch as one message, retry when Telegram asks to slow down."""
+        options = merge(batch)
+        send = getattr(batch[0].bot, batch[0].method)
+        error = None
+        for attempt in range(self.max_attempts):
+            if batch[0].method == 'send_chat_action':
+                # Actions don't take the chat's token, the message they announce needs it.
+                self.rate_limiter.global_bucket.acquire()
+            else:
+                self.rate_limiter.acquire(chat_id)
+            try:
+                with metrics.timer(metrics.HTTP_REQUEST_DURATION, upstream='telegram'):
+                    sent = send(chat_id=chat_id, **options)
+            except RetryAfter as e:
+                logger.warning('Flood limit hit, retrying message to %s in %s s', chat_id, e.retry_after)
+                self.rate_limiter.global_bucket.pause(e.retry_after)
+                error = e
+            except Exception as e:
+                error = e
+                break
+            else:
+                for message in batch:
+                    message.future.set_result(sent)
+                return
+
+        logger.warning('Could not send message to %s: %s', chat_id, error)
+        metrics.registry.inc(metrics.MESSAGES_FAILED)
+        for message in batch:
+            message.future.set_exception(error)
+
+
+rate_limiter = RateLimiter(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE)
+send_queue = SendQueue(rate_limiter, SEND_WORKERS, SEND_MAX_ATTEMPTS)
+
+
+def reply(update, text, **options):
+    """Queue reply to the chat of the update, like update.message.reply_text without waiting for Telegram."""
+    return send_queue.send(update.effective_message.bot, update.effective_chat.id, text, **options)
+
+
+def reply_document(update, document, filename, **options):
+    """Queue document to the chat of the update. Content is read now, so the file can be closed right away."""
+    from telegram import InputFile
+
+    return send_queue.submit(update.effective_message.bot, 'send_document', update.effective_chat.id,
+                             document=InputFile(document, filename=filename), **options)
+
+
+def send_chat_action(update, action):
+    """Queue chat action, so it goes after the messages queued to the chat before."""
+    return send_queue.submit(update.effective_message.bot, 'send_chat_action', update.effective_chat.id,
+                             action=action)
@@ -17,3 +17,47 @@ HEATING_PASSWORD = os.getenv("HEATING_PASSWORD")
 HEATING_LOGIN_API = os.getenv("HEATING_LOGIN_API")
 HEATING_BILL_API = os.getenv("HEATING_BILL_API")
 HEATING_PROVIDER_ID = os.getenv("HEATING_PROVIDER_ID")
+EXCHANGE_RATE_API = os.getenv("EXCHANGE_RATE_API", "https://api.privatbank.ua/p24api/pubinfo?json&exchange&coursid=5")
+EXCHANGE_RATE_TTL = int(os.getenv("EXCHANGE_RATE_TTL", 3600))
+EXCHANGE_RATE_TIMEOUT = float(os.getenv("EXCHANGE_RATE_TIMEOUT", 5))
+HEATING_ACCOUNT = os.getenv("HEATING_ACCOUNT")
+HEATING_TOKEN_TTL = int(os.getenv("HEATING_TOKEN_TTL", 3600))
+HEATING_TIMEOUT = float(os.getenv("HEATING_TIMEOUT", 10))
+HEATING_POOL_SIZE = int(os.getenv("HEATING_POOL_SIZE", 2))
+EXCHANGE_RATE_DEADLINE = float(os.getenv("EXCHANGE_RATE_DEADLINE", 2))
+HEATING_DEADLINE = float(os.getenv("HEATING_DEADLINE", 5))
+BILL_WORKERS = int(os.getenv("BILL_WORKERS", 4))
+BILL_PENDING_RETRY = int(os.getenv("BILL_PENDING_RETRY", 300))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 3600))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", 30))
+UPDATER_WORKERS = int(os.getenv("UPDATER_WORKERS", 4))
+RATES_CACHE_TTL = int(os.getenv("RATES_CACHE_TTL", 60))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 100))
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_URL_PATH = os.getenv("WEBHOOK_URL_PATH", TELEGRAM_TOKEN or "")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_CERT = os.getenv("WEBHOOK_CERT")
+WEBHOOK_KEY = os.getenv("WEBHOOK_KEY")
+FLAT_CACHE_TTL = int(os.getenv("FLAT_CACHE_TTL", 300))
+RENDER_CACHE_TTL = int(os.getenv("RENDER_CACHE_TTL", 300))
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1))
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", 8))
+SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", 3))
+OUTBOX_INTERVAL = int(os.getenv("OUTBOX_INTERVAL", 10))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 50))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 8))
+OUTBOX_BACKOFF = int(os.getenv("OUTBOX_BACKOFF", 30))
+OUTBOX_MAX_BACKOFF = int(os.getenv("OUTBOX_MAX_BACKOFF", 3600))
+PHOTO_STORE_DIR = os.getenv("PHOTO_STORE_DIR", "data/photos")
+PHOTO_WORKERS = int(os.getenv("PHOTO_WORKERS", 2))
+PERSISTENCE_PATH = os.getenv("PERSISTENCE_PATH", "data/bot_state.sqlite3")
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", 1))
+DB_CREATE_SCHEMA = os.getenv("DB_CREATE_SCHEMA", "").lower() in ("1", "true", "yes")
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+METRICS_LOG_INTERVAL = int(os.getenv("METRICS_LOG_INTERVAL", 300))
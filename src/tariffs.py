@@ -0,0 +1,140 @@
+"""Tiered, effective-dated tariffs of the consumption utilities.
+
+Tariff of a utility is a list of tiers (start, price): consumption above start is charged by price until the start
+of the next tier. Cost of every tier below is precomputed, so the cost of any amount is one bisect and one
+multiplication. Tariff versions of a flat apply from their effective date until the next version.
+"""
+import bisect
+import threading
+from collections import namedtuple
+from datetime import date, datetime
+
+UTILITIES = ('electricity', 'gas', 'water')
+EPOCH = date(1970, 1, 1)
+# Flat id and effective date are packed into one int64 key for searchsorted: flat_id * KEY_SCALE + days since epoch.
+KEY_SCALE = 1 << 20
+
+
+class Tariff(namedtuple('Tariff', ('starts', 'prices', 'base_costs'))):
+    """Tiered price. base_costs[i] is the cost of consumption up to starts[i]."""
+
+    __slots__ = ()
+
+    @staticmethod
+    def from_tiers(tiers):
+        """Build tariff from [(start, price), ...]. The first tier has to start at 0."""
+        tiers = sorted((float(start), float(price)) for start, price in tiers)
+        if not tiers or tiers[0][0] != 0:
+            raise ValueError('First tier has to start at 0')
+        starts, prices = zip(*tiers)
+        if len(set(starts)) != len(starts):
+            raise ValueError('Tiers have to start at different amounts')
+
+        base_costs = [0.0]
+        for i in range(1, len(starts)):
+            base_costs.append(base_costs[-1] + (starts[i] - starts[i - 1]) * prices[i - 1])
+        return Tariff(starts, prices, tuple(base_costs))
+
+    @property
+    def tiers(self):
+        return list(zip(self.starts, self.prices))
+
+    def cost(self, amount):
+        """Cost of the consumed amount. Negative amounts (e.g. corrected counters) are charged by the first tier."""
+        i = max(bisect.bisect_right(self.starts, amount) - 1, 0)
+        return self.base_costs[i] + (amount - self.starts[i]) * self.prices[i]
+
+
+def to_date(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+class TariffIndex:
+    """Tariff versions of many flats, sorted by effective date for every flat and utility."""
+
+    def __init__(self, versions):
+        """versions: {(flat_id, utility): [(effective_from, Tariff), ...] sorted by effective_from}."""
+        self._dates = {key: [effective_from for effective_from, _ in items] for key, items in versions.items()}
+        self._tariffs = {key: [tariff for _, tariff in items] for key, items in versions.items()}
+        self._arrays = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_rows(rows):
+        """Build index from (flat_id, utility, effective_from, start, price) rows."""
+        tiers = {}
+        for flat_id, utility, effective_from, start, price in rows:
+            tiers.setdefault((flat_id, utility), {}).setdefault(to_date(effective_from), []).append((start, price))
+
+        # Most flats share the same prices, so equal versions share one Tariff.
+        tariffs = {}
+        for versions in tiers.values():
+            for effective_from, version_tiers in versions.items():
+                key = tuple(sorted(version_tiers))
+                if key not in tariffs:
+                    tariffs[key] = Tariff.from_tiers(key)
+                versions[effective_from] = tariffs[key]
+        return TariffIndex({key: sorted(versions.items()) for key, versions in tiers.items()})
+
+    def find(self, flat_id, utility, on):
+        """Returns tariff of the flat utility in effect on the date or None if there is no version yet."""
+        dates = self._dates.get((flat_id, utility))
+        if not dates:
+            return None
+        i = bisect.bisect_right(dates, to_date(on)) - 1
+        return self._tariffs[(flat_id, utility)][i] if i >= 0 else None
+
+    def get_flat_tariffs(self, flat_id, on):
+        """Returns {utility: Tariff} in effect on the date. Utilities without a version yet are left out."""
+        tariffs = {utility: self.find(flat_id, utility, on) for utility in UTILITIES}
+        return {utility: tariff for utility, tariff in tariffs.items() if tariff}
+
+    def cost_many(self, utility, flat_ids, days, amounts):
+        """Vectorized Tariff.cost for many (flat, day, amount), each with the version in effect on its day.
+        days are anything numpy converts to datetime64[D]. NaN where the flat has no version on the day."""
+        import numpy as np
+
+        keys, starts, prices, base_costs = self._utility_arrays(utility)
+        flat_ids = np.asarray(flat_ids, dtype=np.int64)
+        amounts = np.asarray(amounts, dtype=float)
+        result = np.full(len(amounts), np.nan)
+        if not len(keys) or not len(amounts):
+            return result
+
+        days = np.asarray(days, dtype='datetime64[D]').astype(np.int64)
+        version = np.searchsorted(keys, flat_ids * KEY_SCALE + days, side='right') - 1
+        found = version >= 0
+        found[found] = keys[version[found]] // KEY_SCALE == flat_ids[found]
+
+        version, amounts_found = version[found], amounts[found]
+        tier = np.maximum((amounts_found[:, None] >= starts[version]).sum(axis=1) - 1, 0)
+        result[found] = base_costs[version, tier] + (amounts_found - starts[version, tier]) * prices[version, tier]
+        return result
+
+    def _utility_arrays(self, utility):
+        """Versions of all flats for the utility as arrays: sorted keys and tiers padded to the same width."""
+        with self._lock:
+            if utility not in self._arrays:
+                self._arrays[utility] = self._build_arrays(utility)
+            return self._arrays[utility]
+
+    def _build_arrays(self, utility):
+        import numpy as np
+
+        keys, versions = [], []
+        for (flat_id, key_utility), dates in sorted(self._dates.items()):
+            if key_utility != utility:
+                continue
+            for effective_from, tariff in zip(dates, self._tariffs[(flat_id, utility)]):
+                keys.append(flat_id * KEY_SCALE + (effective_from - EPOCH).days)
+                versions.append(tariff)
+
+        width = max((len(tariff.starts) for tariff in versions), default=1)
+        starts = np.full((len(versions), width), np.inf)
+        prices = np.zeros((len(versions), width))
+        base_costs = np.zeros((len(versions), width))
+        for i, tariff in enumerate(versions):
+            starts[i, :len(tariff.starts)] = tariff.starts
+            prices[i, :len(tariff.prices)] = tariff.prices
+            base_costs[i, :len(tariff.base_costs)] = tariff.base_costs
+        return np.array(keys, dtype=np.int64), starts, prices, base_costs